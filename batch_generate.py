@@ -0,0 +1,221 @@
+"""
+Headless batch generation of diagrams from a JSONL file of prompts.
+
+Every input line is a JSON record:
+    {"id": "checkout-flow", "instruction": "...", "diagram_type": "Sequence Diagram",
+     "options": {"include_title": true, "use_aws_orange_theme": true, "use_note": true, "use_illustration": true}}
+
+Only "instruction" is required. "id" defaults to the line number, "diagram_type" to
+"Let AI decide best Diagram" and every option to the default of the Streamlit sidebar.
+
+For every record, <id>.puml and <id>.png (or <id>.svg with --format svg) are written to the
+output directory and one line with the status, timings and error is appended to results.jsonl.
+Ids that are not safe file names are cleaned up and suffixed with a short hash of the id, so
+"a/b" and "a b" get files of their own. A line that is not a JSON object is reported in
+results.jsonl as a failed record and the batch goes on.
+A rerun skips the records already listed there as successful, so an interrupted batch resumes
+where it stopped.
+
+Usage:
+    python batch_generate.py prompts.jsonl --output-dir diagrams/generated --concurrency 8
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+from pathlib import Path
+
+from data import resolve_diagram_type
+from generation import generate_diagram
+from llm_budget import request_budget
+from llm_client import get_client, run_sync
+from prompts import compile_instruction_prompt
+from render_cache import RenderCache
+from render_pipeline import render_diagram
+
+default_models = {
+    'openai': "gpt-4-turbo",
+    'anthropic': "claude-3-sonnet-20240229",
+}
+
+default_options = {
+    'include_title': True,
+    'use_aws_orange_theme': True,
+    'use_note': True,
+    'use_illustration': True,
+}
+
+
+def read_records(input_path):
+    """
+    Reads the prompt records of a JSONL file, skipping blank lines.
+
+    Returns:
+    - tuple: (record id, record) pairs in file order, and (line number, error message) pairs
+      of the lines that are not a JSON object.
+    """
+    records = []
+    invalid = []
+    with open(input_path, encoding='utf-8') as input_file:
+        for line_number, line in enumerate(input_file, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                invalid.append((str(line_number), f"Invalid JSON on line {line_number}: {e}"))
+                continue
+            if not isinstance(record, dict):
+                invalid.append((str(line_number), f"Line {line_number} is not a JSON object"))
+                continue
+            records.append((str(record.get('id', line_number)), record))
+    return records, invalid
+
+
+def completed_ids(results_path):
+    """
+    Returns the ids listed as successful in an existing results file.
+    """
+    done = set()
+    if not os.path.exists(results_path):
+        return done
+    with open(results_path, encoding='utf-8') as results_file:
+        for line in results_file:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash
+                continue
+            if result.get('status') == 'ok':
+                done.add(result['id'])
+    return done
+
+
+def output_name(record_id):
+    # Ids become file names, so keep them to a safe character set. An id changed on the way
+    # gets a short hash of itself, so ids that clean up to the same name keep distinct files
+    name = re.sub(r"[^\w.-]+", "_", record_id).strip("._") or "diagram"
+    if name != record_id:
+        name += "-" + hashlib.sha256(record_id.encode('utf-8')).hexdigest()[:8]
+    return name
+
+
+async def process_record(client, record_id, record, output_dir, render, retries, output_format='png'):
+    """
+    Generates, renders and saves the diagram of one record.
+
+    Returns:
+    - dict: The result line of the record.
+    """
+    started_at = time.monotonic()
+    diagram_type = record.get('diagram_type', "Let AI decide best Diagram")
+    options = {**default_options, **record.get('options', {})}
+    result = {'id': record_id, 'diagram_type': diagram_type}
+    try:
+        if resolve_diagram_type(diagram_type) is None:
+            raise ValueError(f"Unknown diagram type: {diagram_type}")
+        instruction = compile_instruction_prompt(diagram_type, **options)
+        result['prompt_hash'] = instruction.prompt_hash
+        # Each record gets the token and time budget of one request (LLM_REQUEST_* variables)
+        with request_budget() as budget:
+            plantuml_code, image_bytes, error_message, attempts = await generate_diagram(
+                client, instruction.text, record['instruction'], render, retries=retries, diagram_type=diagram_type
+            )
+        result['tokens'] = budget.tokens_used
+    except Exception as e:
+        plantuml_code, image_bytes, error_message, attempts = None, None, f"{type(e).__name__}: {e}", 0
+
+    name = output_name(record_id)
+    if plantuml_code:
+        (output_dir / f"{name}.puml").write_text(plantuml_code, encoding='utf-8')
+        result['puml'] = f"{name}.puml"
+    if image_bytes:
+        (output_dir / f"{name}.{output_format}").write_bytes(image_bytes)
+        result['image'] = f"{name}.{output_format}"
+    result.update({
+        'status': 'ok' if image_bytes else 'error',
+        'error': error_message,
+        'attempts': attempts,
+        'seconds': round(time.monotonic() - started_at, 3),
+    })
+    return result
+
+
+async def run_batch(client, records, output_dir, results_path, render, concurrency=4, retries=3, output_format='png'):
+    """
+    Processes records with at most `concurrency` of them in flight, appending each result as it finishes.
+
+    Returns:
+    - tuple: (number of successful records, number of failed records).
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    counts = {'ok': 0, 'error': 0}
+
+    with open(results_path, 'a', encoding='utf-8') as results_file:
+        async def run_one(record_id, record):
+            async with semaphore:
+                result = await process_record(client, record_id, record, output_dir, render, retries, output_format)
+            # One complete line per record, flushed at once, so a crash loses at most the records in flight
+            results_file.write(json.dumps(result) + "\n")
+            results_file.flush()
+            counts[result['status']] += 1
+            print(f"[{result['status']}] {record_id} in {result['seconds']} s" + (f": {result['error']}" if result['error'] else ""), file=sys.stderr)
+
+        await asyncio.gather(*(run_one(record_id, record) for record_id, record in records))
+
+    return counts['ok'], counts['error']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate diagrams in bulk from a JSONL file of prompts.")
+    parser.add_argument('input', help="JSONL file with one prompt record per line.")
+    parser.add_argument('--output-dir', default='batch_output', help="Directory receiving the diagrams and results.jsonl.")
+    parser.add_argument('--results', help="Results file, by default results.jsonl in the output directory.")
+    parser.add_argument('--concurrency', type=int, default=4, help="Records processed at the same time.")
+    parser.add_argument('--retries', type=int, default=3, help="Maximum LLM calls per record.")
+    parser.add_argument('--provider', choices=sorted(default_models), default='openai')
+    parser.add_argument('--model', help="Model name, by default the one of the Streamlit agent for the provider.")
+    parser.add_argument('--format', choices=['png', 'svg'], default='png', help="Image format of the diagrams.")
+    parser.add_argument('--plantuml-jar', default='./plantuml.jar')
+    parser.add_argument('--no-render-cache', action='store_true', help="Render every diagram even if it is cached.")
+    args = parser.parse_args(argv)
+
+    # Same secrets as the Streamlit agents, read from the environment: OPENAI_API_KEY, ANTHROPIC_BASE_URL...
+    prefix = args.provider.upper()
+    api_key = os.environ.get(f"{prefix}_API_KEY")
+    if not api_key:
+        parser.error(f"{prefix}_API_KEY is not set.")
+    client = get_client(args.provider, api_key=api_key, model=args.model or default_models[args.provider], base_url=os.environ.get(f"{prefix}_BASE_URL"))
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    results_path = args.results or str(output_dir / 'results.jsonl')
+
+    records, invalid = read_records(args.input)
+    done = completed_ids(results_path)
+    pending = [(record_id, record) for record_id, record in records if record_id not in done]
+    print(f"{len(records)} records, {len(records) - len(pending)} already done, {len(pending)} to generate", file=sys.stderr)
+
+    # Unreadable lines fail on their own instead of stopping the batch
+    with open(results_path, 'a', encoding='utf-8') as results_file:
+        for line_id, error_message in invalid:
+            results_file.write(json.dumps({'id': line_id, 'status': 'error', 'error': error_message, 'attempts': 0, 'seconds': 0}) + "\n")
+            print(f"[error] {error_message}", file=sys.stderr)
+
+    render_cache = None if args.no_render_cache else RenderCache('./.render_cache')
+
+    def render(plantuml_code):
+        return render_diagram(plantuml_code, args.plantuml_jar, render_cache=render_cache, output_format=args.format)
+
+    succeeded, failed = run_sync(run_batch(client, pending, output_dir, results_path, render, args.concurrency, args.retries, args.format))
+    failed += len(invalid)
+    print(f"{succeeded} succeeded, {failed} failed", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
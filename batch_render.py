@@ -0,0 +1,132 @@
+"""
+Renders many PlantUML files at once, with one or a few warm JVMs.
+
+Every .puml, .plantuml or .txt file given, directly or inside a directory, is rendered to a
+file of the same name, next to it or in the output directory. There, files found inside a
+directory keep their path relative to it, so a/x.puml and b/x.puml do not overwrite each
+other. Inside a directory, .txt files are only picked up when they contain a @start tag.
+A file with several @start ... @end blocks gives one image per block, named like PlantUML
+does: x.png for the first block, then x_001.png, x_002.png... Diagrams that fail are listed
+with their error.
+
+Usage:
+    python batch_render.py diagrams/ --output-dir diagrams/rendered --format png
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+from plantuml_validator import end_tag_pattern, start_tag_pattern
+from render_cache import RenderCache
+from render_pipeline import render_diagrams
+
+source_suffixes = ('.puml', '.plantuml', '.txt')
+
+
+def find_sources(paths):
+    """
+    Returns the PlantUML files given on the command line, expanding directories recursively.
+
+    Returns:
+    - list: (path, path relative to the directory given, or the bare file name) pairs.
+    """
+    sources = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            sources.extend((p, p.relative_to(path)) for p in sorted(path.rglob('*')) if is_source(p))
+        else:
+            sources.append((path, Path(path.name)))
+    return sources
+
+
+def is_source(path):
+    # Plenty of .txt files are not PlantUML, so those need a @start tag to be picked up
+    if path.suffix not in source_suffixes or not path.is_file():
+        return False
+    if path.suffix == '.txt':
+        try:
+            return '@start' in path.read_text(encoding='utf-8', errors='replace')
+        except OSError:
+            return False
+    return True
+
+
+def split_blocks(text):
+    """
+    Splits the content of a file into its @start ... @end blocks, the way PlantUML reads it.
+
+    Returns:
+    - list: The source of each block, or the whole text when it has no @start tag.
+    """
+    blocks = []
+    block = None
+    for line in text.splitlines():
+        if block is None:
+            if start_tag_pattern.match(line):
+                block = [line]
+        else:
+            block.append(line)
+            if end_tag_pattern.match(line):
+                blocks.append("\n".join(block))
+                block = None
+    if block is not None:
+        # Unterminated: left for the validator to report
+        blocks.append("\n".join(block))
+    return blocks or [text]
+
+
+def output_path(path, relative_path, output_dir, output_format, index=0):
+    # Blocks after the first get a numbered name, as PlantUML itself names them
+    name = f"{path.stem}_{index:03d}" if index else path.stem
+    if output_dir is None:
+        return path.with_name(f"{name}.{output_format}")
+    return Path(output_dir) / relative_path.with_name(f"{name}.{output_format}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render many PlantUML files with one or a few JVMs.")
+    parser.add_argument('paths', nargs='+', help="PlantUML files or directories of them.")
+    parser.add_argument('--output-dir', help="Directory receiving the images, by default next to each source.")
+    parser.add_argument('--format', default='png', help="PlantUML output format, e.g. png or svg.")
+    parser.add_argument('--shards', type=int, help="Number of JVMs, by default one per 20 files up to one per core.")
+    parser.add_argument('--timeout', type=float, default=60, help="Seconds allowed for each render.")
+    parser.add_argument('--plantuml-jar', default='./plantuml.jar')
+    parser.add_argument('--no-render-cache', action='store_true', help="Render every file even if it is cached.")
+    args = parser.parse_args(argv)
+
+    # One diagram per @start ... @end block of every file
+    source_names = []
+    output_paths = []
+    sources = []
+    for path, relative_path in find_sources(args.paths):
+        blocks = split_blocks(path.read_text(encoding='utf-8'))
+        for index, block in enumerate(blocks):
+            source_names.append(f"{path} (diagram {index + 1})" if len(blocks) > 1 else str(path))
+            output_paths.append(output_path(path, relative_path, args.output_dir, args.format, index))
+            sources.append(block)
+    # Two sources writing the same image would silently overwrite each other
+    seen = {}
+    for name, image_path in zip(source_names, output_paths):
+        if image_path in seen:
+            parser.error(f"{seen[image_path]} and {name} would both be rendered to {image_path}.")
+        seen[image_path] = name
+    render_cache = None if args.no_render_cache else RenderCache('./.render_cache')
+
+    started_at = time.monotonic()
+    results = render_diagrams(sources, args.plantuml_jar, render_cache=render_cache, output_format=args.format, shards=args.shards, timeout=args.timeout)
+
+    failed = 0
+    for name, image_path, (image_bytes, error_message) in zip(source_names, output_paths, results):
+        if image_bytes:
+            image_path.parent.mkdir(parents=True, exist_ok=True)
+            image_path.write_bytes(image_bytes)
+        else:
+            failed += 1
+            print(f"{name}: {error_message}", file=sys.stderr)
+    print(f"Rendered {len(sources) - failed} of {len(sources)} diagrams in {time.monotonic() - started_at:.1f} s", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
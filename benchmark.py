@@ -0,0 +1,310 @@
+"""
+Benchmark of the generation and rendering pipeline.
+
+A local fake LLM server speaking the OpenAI chat completions API answers every request with
+the example of the requested diagram type, streamed at a configurable pace. Every diagram type
+of data.catalog then goes through the same stages as the Streamlit agent: streamed generation,
+extraction and rendering with the real plantuml.jar. The diagram caches are not used, so every
+iteration pays for a render.
+
+The report has the p50/p95/p99 latency of each stage, the throughput at each concurrency level,
+the peak memory of Python and of the JVMs, the number of JVMs started, and the cold import time
+of the main modules. It is saved as JSON so that two commits can be compared.
+
+Usage:
+    python benchmark.py --iterations 5 --concurrency 1 4 8 --output bench_results/latest.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from data import catalog
+from generation import stream_plantuml
+from llm_budget import get_budget_governor
+from llm_client import get_client, run_sync
+from plantuml_streaming import extract_plantuml_code
+from prompts import build_instruction_message
+from render_pipeline import render_diagram
+from render_scheduler import get_scheduler
+
+# Answer of the fake server when the example of a diagram type has no PlantUML block
+fallback_diagram = "@startuml\nAlice -> Bob: Hello\nBob --> Alice: Hi\n@enduml"
+
+example_pattern = re.compile(r"@start\w+.*?@end\w+", re.DOTALL)
+
+# Modules whose cold import time is measured; the agents import them on every new process
+import_modules = ['data', 'prompts', 'llm_client', 'generation', 'render_pipeline', 'telemetry', 'streamlit']
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    """
+    Minimal OpenAI-compatible /chat/completions endpoint, streaming or not.
+
+    The answer is the first PlantUML block of the system message, which is the example of the
+    requested diagram type, wrapped in a sentence of prose on each side like a real model does.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    chunk_size = 16
+    chunk_delay = 0.005
+
+    def log_message(self, format, *args):
+        pass
+
+    def _answer(self, request):
+        system_message = next((m['content'] for m in request['messages'] if m['role'] == 'system'), "")
+        match = example_pattern.search(system_message)
+        return f"Here is the diagram:\n{match.group(0) if match else fallback_diagram}\nIt shows the requested flow."
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        answer = self._answer(request)
+        model = request.get('model', 'fake')
+
+        if not request.get('stream'):
+            body = json.dumps({
+                'id': 'fake', 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': answer}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+            }).encode()
+            time.sleep(self.chunk_delay * len(answer) / self.chunk_size)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for start in range(0, len(answer), self.chunk_size):
+                time.sleep(self.chunk_delay)
+                event = {
+                    'id': 'fake', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+                    'choices': [{'index': 0, 'delta': {'content': answer[start:start + self.chunk_size]}, 'finish_reason': None}],
+                }
+                self._write_chunk(f"data: {json.dumps(event)}\n\n".encode())
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading at the @end tag
+            self.close_connection = True
+
+
+def start_fake_llm_server(chunk_size=16, chunk_delay=0.005):
+    """
+    Starts the fake LLM server on a free local port, in a daemon thread.
+
+    Returns:
+    - ThreadingHTTPServer: The running server; its base URL is http://127.0.0.1:<port>/v1.
+    """
+    handler = type('ConfiguredFakeLLMHandler', (FakeLLMHandler,), {'chunk_size': chunk_size, 'chunk_delay': chunk_delay})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def percentiles(values):
+    """
+    Returns the p50, p95 and p99 of a list of durations, in milliseconds.
+    """
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None, 'count': 0}
+    values = sorted(values)
+
+    def at(fraction):
+        return round(values[min(len(values) - 1, int(len(values) * fraction))] * 1000, 2)
+
+    return {'p50': at(0.50), 'p95': at(0.95), 'p99': at(0.99), 'count': len(values)}
+
+
+def rss_mb(pid):
+    # Resident memory of a process, from /proc on Linux; None elsewhere
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+
+async def run_one(client, diagram_type, render, timings):
+    # One request through the stages of the agent, each timed separately
+    instruction_message = build_instruction_message(diagram_type, True, True, True, True)
+    started_at = time.perf_counter()
+    generated_code = await stream_plantuml(client, instruction_message, f"Draw a {diagram_type}.")
+    generated_at = time.perf_counter()
+    plantuml_code = extract_plantuml_code(generated_code)
+    extracted_at = time.perf_counter()
+    image_bytes, error_message = await asyncio.get_running_loop().run_in_executor(None, render, plantuml_code)
+    rendered_at = time.perf_counter()
+
+    timings['generate'].append(generated_at - started_at)
+    timings['extract'].append(extracted_at - generated_at)
+    timings['render'].append(rendered_at - extracted_at)
+    timings['total'].append(rendered_at - started_at)
+    timings.setdefault(diagram_type, []).append(rendered_at - started_at)
+    if not image_bytes:
+        timings['errors'].append(f"{diagram_type}: {error_message}")
+
+
+async def run_level(client, diagram_types, iterations, concurrency, render, sample_jvms):
+    # Runs every diagram type `iterations` times with at most `concurrency` requests in flight
+    timings = {'generate': [], 'extract': [], 'render': [], 'total': [], 'errors': []}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(diagram_type):
+        async with semaphore:
+            await run_one(client, diagram_type, render, timings)
+            sample_jvms()
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(limited(diagram_type) for _ in range(iterations) for diagram_type in diagram_types))
+    elapsed = time.perf_counter() - started_at
+    return timings, elapsed
+
+
+def measure_import_times(modules, runs=5):
+    """
+    Returns the median cold import time of each module in milliseconds, each run in a fresh interpreter.
+
+    Modules that are not installed are reported as None.
+    """
+    import_times = {}
+    for module in modules:
+        samples = []
+        for _ in range(runs):
+            completed = subprocess.run(
+                [sys.executable, '-c', f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"],
+                capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+            )
+            if completed.returncode != 0:
+                break
+            samples.append(float(completed.stdout.strip()))
+        import_times[module] = round(sorted(samples)[len(samples) // 2] * 1000, 2) if samples else None
+    return import_times
+
+
+def measure_prompt_build(diagram_types, runs=1000):
+    # Per-rerun cost of building the instruction message, in microseconds per call
+    started_at = time.perf_counter()
+    for _ in range(runs):
+        for diagram_type in diagram_types:
+            build_instruction_message(diagram_type, True, True, True, True)
+    return round((time.perf_counter() - started_at) / (runs * len(diagram_types)) * 1e6, 3)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the generation and rendering pipeline.")
+    parser.add_argument('--iterations', type=int, default=5, help="Requests per diagram type and concurrency level.")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8], help="Concurrency levels to measure.")
+    parser.add_argument('--chunk-size', type=int, default=16, help="Characters per streamed chunk of the fake LLM.")
+    parser.add_argument('--chunk-delay', type=float, default=0.005, help="Seconds between two streamed chunks.")
+    parser.add_argument('--plantuml-jar', default='./plantuml.jar')
+    parser.add_argument('--startup-only', action='store_true', help="Only measure import times and prompt building, without LLM or JVM.")
+    parser.add_argument('--output', default=f"bench_results/{time.strftime('%Y%m%d-%H%M%S')}.json", help="Where to save the JSON report.")
+    args = parser.parse_args(argv)
+
+    diagram_types = list(catalog)
+    startup = {
+        'import_ms': measure_import_times(import_modules),
+        'prompt_build_us': measure_prompt_build(diagram_types),
+    }
+    print(f"imports (ms): {startup['import_ms']}, prompt build: {startup['prompt_build_us']} us", file=sys.stderr)
+    if args.startup_only:
+        report = {'revision': git_revision(), 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(), 'startup': startup}
+        output = Path(args.output)
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(report, indent=2), encoding='utf-8')
+        return 0
+
+    server = start_fake_llm_server(args.chunk_size, args.chunk_delay)
+    client = get_client('openai', api_key='benchmark', model='fake', base_url=f"http://127.0.0.1:{server.server_port}/v1")
+    # The fake server costs nothing, and the process token limit would throttle the higher levels
+    get_budget_governor().tokens_per_minute = 0
+    scheduler = get_scheduler(args.plantuml_jar)
+
+    jvm_peak_mb = [0.0]
+
+    def sample_jvms():
+        live = [renderer.pid for renderer in scheduler.live_renderers()]
+        jvm_peak_mb[0] = max(jvm_peak_mb[0], sum(rss_mb(pid) or 0 for pid in live if pid))
+
+    def render(plantuml_code):
+        return render_diagram(plantuml_code, args.plantuml_jar) if plantuml_code else (None, "No valid PlantUML code block found.")
+
+    report = {
+        'revision': git_revision(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'render_workers': scheduler.workers,
+        'diagram_types': len(diagram_types),
+        'iterations': args.iterations,
+        'startup': startup,
+        'levels': [],
+    }
+    # One unmeasured request per type warms up the JVMs and the connection pool
+    run_sync(run_level(client, diagram_types, 1, max(args.concurrency), render, sample_jvms))
+
+    for concurrency in args.concurrency:
+        timings, elapsed = run_sync(run_level(client, diagram_types, args.iterations, concurrency, render, sample_jvms))
+        requests = len(timings['total'])
+        level = {
+            'concurrency': concurrency,
+            'requests': requests,
+            'errors': len(timings['errors']),
+            'error_samples': timings['errors'][:5],
+            'seconds': round(elapsed, 3),
+            'throughput_per_s': round(requests / elapsed, 2) if elapsed else None,
+            'stages_ms': {stage: percentiles(timings[stage]) for stage in ('generate', 'extract', 'render', 'total')},
+            'diagram_types_ms': {diagram_type: percentiles(timings[diagram_type]) for diagram_type in diagram_types},
+        }
+        report['levels'].append(level)
+        total = level['stages_ms']['total']
+        print(f"concurrency {concurrency}: {level['throughput_per_s']} req/s, total p50 {total['p50']} ms, p95 {total['p95']} ms, p99 {total['p99']} ms, {level['errors']} errors", file=sys.stderr)
+
+    report['memory_mb'] = {
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        'python_peak': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1),
+        'jvm_peak': round(jvm_peak_mb[0], 1),
+    }
+    # Counted by the pool, so JVMs that started and died between two samples are included
+    report['jvms_started'] = scheduler.jvms_started()
+
+    output = Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2), encoding='utf-8')
+    print(f"{report['jvms_started']} JVMs, JVM peak {report['memory_mb']['jvm_peak']} MB, Python peak {report['memory_mb']['python_peak']} MB; saved to {output}", file=sys.stderr)
+    server.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,32 +1,27 @@
-# Diagram types list
-diagram_types = [
-    "Let AI decide best Diagram",
-    "Class Diagram",
-    "Use Case Diagram",
-    "Sequence Diagram",
-    "Activity Diagram (Flow Chart) - New Syntax",
-    "Component Diagram",
-    "State Diagram",
-    "Object Diagram",
-    "Deployment Diagram",
-    "Timing Diagram",
-    "Interaction Overview Diagram",
-    "Wireframe",
-    "Archimate Diagram",
-    "Gantt Chart",
-    "MindMap Diagram",
-    "Work Breakdown Structure (WBS) Diagram",
-    "JSON Data",
-    "YAML Data",
-    "EBNF diagram",
-    "Network diagram (nwdiag)",
-    "Salt (Wireframe)",
-    "ArchiMate Diagram",
-    "Gantt Chart",
-    "MindMap",
-    "Maths",
-    "Entity Relationship Diagram"
-]
+import re
+import types
+
+# Other spellings of diagram types, accepted in saved requests and batch files
+diagram_type_aliases = {
+    "Archimate Diagram": "ArchiMate Diagram",
+    "MindMap": "MindMap Diagram",
+}
+
+# Render hints per diagram type; types that are not listed use default_render_profile.
+# Wide or tall diagrams prefer SVG, which has no pixel size limit.
+default_render_profile = {'format': 'png', 'timeout': 30}
+render_profiles = {
+    "Sequence Diagram": {'format': 'svg', 'timeout': 60},
+    "Deployment Diagram": {'format': 'svg', 'timeout': 60},
+    "Component Diagram": {'format': 'svg', 'timeout': 60},
+    "Network diagram (nwdiag)": {'format': 'svg', 'timeout': 60},
+    "Gantt Chart": {'format': 'svg', 'timeout': 60},
+    "Work Breakdown Structure (WBS) Diagram": {'format': 'svg', 'timeout': 60},
+    "Maths": {'format': 'png', 'timeout': 20},
+}
+
+# The type whose example is only a start tag: the model picks the diagram
+any_diagram_type = "Let AI decide best Diagram"
 
 
 diagrams = [
@@ -118,12 +113,12 @@ diagrams = [
     {
       "diagram_type": "JSON Data",
       "useful_for": "Data interchange between systems.",
-      "example": "{\n\"key\": \"value\"\n}"
+      "example": "@startjson\n{\n\"key\": \"value\"\n}\n@endjson"
     },
     {
       "diagram_type": "YAML Data",
       "useful_for": "Configuration files and data serialization.",
-      "example": "key: value"
+      "example": "@startyaml\nkey: value\n@endyaml"
     },
     {
       "diagram_type": "EBNF diagram",
@@ -147,6 +142,87 @@ diagrams = [
     }
     ]
 
+
+class DiagramRecord:
+    """
+    Read-only catalog entry of one diagram type.
+
+    Besides the catalog data, a record carries its @start/@end tag (None when any tag will do),
+    the pattern extracting its code from an LLM answer and its render hints.
+    """
+
+    __slots__ = ('diagram_type', 'useful_for', 'example', 'start_tag', 'extraction_pattern', 'render_format', 'render_timeout')
+
+    def __init__(self, diagram_type, useful_for, example, start_tag, extraction_pattern, render_format, render_timeout):
+        for name, value in (
+            ('diagram_type', diagram_type),
+            ('useful_for', useful_for),
+            ('example', example),
+            ('start_tag', start_tag),
+            ('extraction_pattern', extraction_pattern),
+            ('render_format', render_format),
+            ('render_timeout', render_timeout),
+        ):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Catalog records are read-only")
+
+    def __repr__(self):
+        return f"DiagramRecord({self.diagram_type!r})"
+
+
+def _build_catalog(diagrams):
+    # Validates the catalog and indexes it by diagram type; a broken entry fails at import, not at generation
+    index = {}
+    for diagram in diagrams:
+        diagram_type = diagram['diagram_type']
+        if diagram_type in index or diagram_type in diagram_type_aliases:
+            raise ValueError(f"Duplicate diagram type in the catalog: {diagram_type}")
+
+        start_tags = [tag.lower() for tag in re.findall(r"^@start(\w+)", diagram['example'], re.MULTILINE)]
+        end_tags = [tag.lower() for tag in re.findall(r"^@end(\w+)", diagram['example'], re.MULTILINE)]
+        if diagram_type == any_diagram_type:
+            start_tag = None
+            extraction_pattern = re.compile(r"@start(\w+).*?@end\1", re.DOTALL | re.IGNORECASE)
+        else:
+            if len(start_tags) != 1 or end_tags != start_tags:
+                raise ValueError(f"The example of {diagram_type} must be one @startXXX ... @endXXX block.")
+            start_tag = start_tags[0]
+            extraction_pattern = re.compile(rf"@start{start_tag}\b.*?@end{start_tag}\b", re.DOTALL | re.IGNORECASE)
+            if not extraction_pattern.search(diagram['example']):
+                raise ValueError(f"The extraction rule of {diagram_type} does not match its own example.")
+
+        profile = {**default_render_profile, **render_profiles.get(diagram_type, {})}
+        index[diagram_type] = DiagramRecord(
+            diagram_type, diagram['useful_for'], diagram['example'], start_tag, extraction_pattern,
+            profile['format'], profile['timeout']
+        )
+
+    for diagram_type in render_profiles:
+        if diagram_type not in index:
+            raise ValueError(f"Render profile for an unknown diagram type: {diagram_type}")
+    for alias, diagram_type in diagram_type_aliases.items():
+        if diagram_type not in index:
+            raise ValueError(f"Alias {alias} points to an unknown diagram type: {diagram_type}")
+    return types.MappingProxyType(index)
+
+
+# Catalog index: diagram type -> DiagramRecord, built and validated once per process when this module is first imported
+catalog = _build_catalog(diagrams)
+
+# Diagram types in catalog order, without duplicates, for select boxes
+diagram_type_names = tuple(catalog)
+diagram_types = list(diagram_type_names)
+
+
+def resolve_diagram_type(diagram_type):
+    """
+    Returns the catalog record of a diagram type or of one of its aliases, or None when it is unknown.
+    """
+    return catalog.get(diagram_type_aliases.get(diagram_type, diagram_type))
+
+
 sample_plantuml = '''@startuml
 participant User
 participant "TSLivechat" as TSL
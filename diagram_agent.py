@@ -1,212 +1,375 @@
 import streamlit as st
-import subprocess
 import os
-import re
-from pathlib import Path
-import openai
-import tempfile
-from data import diagrams
-import glob
-import pandas as pd
-
-# import the list of supported diagrams
-df_diagrams = pd.DataFrame(diagrams)
-
-# Directory for storing output diagrams
-output_dir = Path('./diagrams')
+import base64
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from data import catalog, diagram_type_names
+from generation import best_of_n_candidates, first_valid_diagram
+from llm_budget import BudgetExceeded, SessionBudget, get_budget_governor, min_max_tokens, request_budget, request_token_budget
+from llm_client import get_client, iterate_sync, run_sync
+from llm_router import get_router
+from plantuml_streaming import collect_until_plantuml_end, extract_plantuml_code
+from prompts import compile_instruction_prompt, plan_message
+from plantuml_repair import apply_repair_patch, build_repair_prompt, repair_system_message
+from render_cache import RenderCache
+from render_pipeline import render_diagram
+from telemetry import current_span, get_telemetry, span, start_metrics_server, traced
+from llm_cache import get_response_cache
 
 # Path to the PlantUML .jar file
 plantuml_jar_path = './plantuml.jar'
 
-# Connect to OpenAI key
-openai.api_key = st.secrets["OPENAI_API_KEY"]
+# Models used to generate the PlantUML code, per provider
+openai_model = "gpt-4-turbo"
+anthropic_model = "claude-3-sonnet-20240229"
+
+# Cache of rendered diagrams shared by every session
+render_cache = RenderCache('./.render_cache')
+
+# Cache of LLM responses shared by every session
+response_cache = get_response_cache()
+
+# Token and time budgets of the LLM calls; limits are set through the LLM_* environment variables
+budget_governor = get_budget_governor()
+
+# Connect to every configured provider through the shared async clients; the *_BASE_URL secrets
+# can point them at a local stub server
+providers = {
+    'openai': get_client(
+        'openai',
+        api_key=st.secrets["OPENAI_API_KEY"],
+        model=openai_model,
+        base_url=st.secrets.get("OPENAI_BASE_URL")
+    )
+}
+if st.secrets.get("ANTHROPIC_API_KEY"):
+    providers['anthropic'] = get_client(
+        'anthropic',
+        api_key=st.secrets["ANTHROPIC_API_KEY"],
+        model=anthropic_model,
+        base_url=st.secrets.get("ANTHROPIC_BASE_URL")
+    )
+
+# Sends each request to the fastest healthy provider and fails over to the others
+router = get_router(list(providers.values()))
+llm = router
+
+# Serve the Prometheus metrics on this port when METRICS_PORT is set
+if os.environ.get('METRICS_PORT'):
+    start_metrics_server(os.environ['METRICS_PORT'])
 
 # Initialize session state for PlantUML code
 if 'plantuml_code' not in st.session_state:
     st.session_state['plantuml_code'] = ""
 
-# Function to convert natural language instruction to PlantUML code using OpenAI
-def nl_to_plantuml(nl_instruction, diagram_type, include_title, use_aws_orange_theme, use_note, use_illustration, error_details=None, failed_code=None):
-    example = df_diagrams[df_diagrams['diagram_type'] == diagram_type]['example'].iloc[0]
-    if diagram_type == "Let AI decide best Diagram":
-        diagram_type = 'most appropriate diagram'
-    # Construct the instruction message based on toggles
-    instruction_message = f"You are a professional PlantUML coder."
-    if include_title:
-        instruction_message += " Include a title."
-    if use_aws_orange_theme:
-        instruction_message += " Use aws-orange theme. Syntax: !theme aws-orange"
-    if use_note:
-        instruction_message += " Use note if needed to explain more details."
-    if use_illustration:
-        instruction_message += " Use group or card if needed."
-    instruction_message += f''' You MUST Output PlantUML code for a {diagram_type} only and explain nothing.
-    For example the code will start with: {example}.
-    '''
+# Tokens used by this session, against the session budget
+if 'session_budget' not in st.session_state:
+    st.session_state['session_budget'] = SessionBudget()
+session_budget = st.session_state['session_budget']
+
+# Function to convert natural language instruction to PlantUML code using the LLM
+@traced('generate')
+def nl_to_plantuml(nl_instruction, diagram_type, include_title, use_aws_orange_theme, use_note, use_illustration, error_details=None, failed_code=None, on_partial=None):
+    # Construct the instruction message based on toggles; it is compiled once per type and options
+    instruction = compile_instruction_prompt(diagram_type, include_title, use_aws_orange_theme, use_note, use_illustration)
+    instruction_message = instruction.text
+    # Sized after the past answers of this diagram type; a retry gets the full default
+    max_tokens = budget_governor.max_tokens(diagram_type, retry=bool(error_details))
+    current_span().set(diagram_type=diagram_type, provider=llm.provider, model=llm.model, prompt_hash=instruction.prompt_hash, retry=bool(error_details), cache_hit=False, max_tokens=max_tokens)
 
     if error_details and failed_code:
-        # nl_instruction += f"\n\nPrevious error details: {error_details}\n\nPlantUML code from diagrams\output.puml:\n{failed_code}\n"
-        # nl_instruction += " Why this PlantUML code doesn't run? Analyze the code for any syntax error and return a corrected PlantUML code."
-        nl_instruction += " You must use Sequence Diagram for this request."
+        # The previous answer for this instruction failed, so it must not be served from the cache again
+        response_cache.discard(instruction.prompt_hash, diagram_type, nl_instruction, model=llm.model)
+        # A targeted repair was not possible, so regenerate while pointing at the previous mistake
+        nl_instruction += f"\n\nThe previous PlantUML code failed with this error, do not repeat it:\n{error_details}"
+    else:
+        # Identical requests with identical options are answered from the response cache
+        cached_code = response_cache.get(instruction.prompt_hash, diagram_type, nl_instruction, model=llm.model)
+        if cached_code:
+            current_span().set(cache_hit=True, output_chars=len(cached_code))
+            if on_partial:
+                on_partial(cached_code)
+            return cached_code
 
     try:
-        # Use the OpenAI API to generate a response
-        print("Instruction message:\n", instruction_message)
-        print("NL Instruction:\n", nl_instruction)
-
-        openai_response = openai.chat.completions.create(
-            model="gpt-4-turbo",
-            messages=[
-                {"role": "system", "content": instruction_message},
-                {"role": "user", "content": nl_instruction}
-            ],
-            temperature=0.5,
-            stream=False,
-        )
-        plantuml_code = openai_response.choices[0].message.content
+        # Use the LLM API to generate a response
+        text_chunks = iterate_sync(llm.stream(instruction_message, nl_instruction, temperature=0.5, max_tokens=max_tokens))
+        try:
+            # Stop reading as soon as the @endXXX tag arrives
+            plantuml_code, _ = collect_until_plantuml_end(text_chunks, on_partial=on_partial)
+        finally:
+            # Closing the stream cancels the rest of the response, so trailing prose is never generated
+            text_chunks.close()
+        current_span().set(output_chars=len(plantuml_code))
+        if extract_plantuml_code(plantuml_code, diagram_type):
+            budget_governor.record_output(diagram_type, plantuml_code)
+        # Cached by cache_rendered_code once it renders, so a broken answer is never served again
         return plantuml_code
+    except BudgetExceeded as e:
+        st.warning(str(e))
+        return None
     except Exception as e:
-        st.error(f"An error occurred with the OpenAI API: {e}")
+        st.error(f"An error occurred with the LLM API: {e}")
         return None
 
-# Function to generate UML diagram from PlantUML code
-def generate_uml_diagram(plantuml_code, output_dir, plantuml_jar_path):
-    retries = 2
-    error_message = None
-
-    output_dir = Path(output_dir)
-    output_dir.mkdir(parents=True, exist_ok=True)  # Ensure output directory exists
-
-    # Define the path for the .puml file
-    output_puml_file = output_dir / "output.puml"
+# Function to fix only the failing lines of PlantUML code using the LLM
+@traced('repair')
+def repair_plantuml(failed_code, error_details):
+    repair_prompt = build_repair_prompt(failed_code, error_details)
+    if not repair_prompt:
+        return None
+    try:
+        patch_text = run_sync(llm.complete(repair_system_message, repair_prompt, temperature=0))
+        return apply_repair_patch(failed_code, patch_text)
+    except BudgetExceeded:
+        # Reported by the regeneration that follows
+        return None
+    except Exception as e:
+        st.error(f"An error occurred with the LLM API: {e}")
+        return None
 
-    # Write the PlantUML code to the .puml file
-    with open(output_puml_file, 'w') as file:
-        file.write(plantuml_code)
+# Function to generate UML diagram from PlantUML code, entirely in memory
+def generate_uml_diagram(plantuml_code, plantuml_jar_path, output_format=None):
+    return render_diagram(
+        plantuml_code,
+        plantuml_jar_path,
+        render_cache=render_cache,
+        output_format=output_format or diagram_format,
+        timeout=catalog[selected_diagram_type].render_timeout,
+        diagram_type=selected_diagram_type
+    )
 
-    while retries >= 0:
-        try:
-            subprocess_result = subprocess.run(
-                ['java',
-                 '-jar', plantuml_jar_path,
-                 str(output_puml_file)],
-                capture_output=True, text=True
-            )
-
-            # Find the generated PNG file
-            png_files = list(output_dir.glob('*.png'))
-            if subprocess_result.returncode == 0 and png_files:
-                # Assume the newest PNG file is the one we just created
-                generated_png_file = max(png_files, key=os.path.getctime)
-                output_png_file = output_dir / "output.png"
-                # Rename the file to output.png
-                generated_png_file.rename(output_png_file)
-                return str(output_puml_file), str(output_png_file), None
-            else:
-                error_message = "Failed to create the output diagram or PlantUML error."
-                if subprocess_result.stderr:
-                    error_message = subprocess_result.stderr
-                retries -= 1
-        except Exception as e:
-            error_message = f"An error occurred: {str(e)}"
-            retries -= 1
-
-    return None, None, error_message
-
-def extract_plantuml_code(full_code):
-    """
-    Extracts the PlantUML code between @startXXX and @endXXX tags.
-    
-    Args:
-    - full_code (str): The full PlantUML code including unwanted text.
-    
-    Returns:
-    - str: The extracted PlantUML code or None if no valid code block is found.
-    """
-    # Regular expression to find blocks starting with @start and ending with @end
-    pattern = re.compile(r"@start\w+.*?@end\w+", re.DOTALL)
-    match = pattern.search(full_code)
-    
-    if match:
-        return match.group(0)  # Return the matched block, including start and end tags
+# Function to display a diagram; SVG is sent as-is and scaled by the browser
+def show_diagram(image_bytes, caption):
+    if diagram_format == 'svg':
+        encoded = base64.b64encode(image_bytes).decode('ascii')
+        st.markdown(f'<img src="data:image/svg+xml;base64,{encoded}" style="max-width: 100%;" alt="{caption}"/>', unsafe_allow_html=True)
+        st.caption(caption)
     else:
-        return None  # Return None if no valid block is found
+        st.image(image_bytes, caption=caption, use_column_width=False)
 
 # Function to create a download link for the image
-def get_image_download_link(img_path):
-    with open(img_path, "rb") as file:
-        btn = st.download_button(
+def get_image_download_link(image_bytes, plantuml_code):
+    if diagram_format != 'svg':
+        return st.download_button(
             label="Download diagram",
-            data=file,
+            data=image_bytes,
             file_name="diagram.png",
             mime="image/png",
             type="primary"
         )
+    btn = st.download_button(
+        label="Download SVG",
+        data=image_bytes,
+        file_name="diagram.svg",
+        mime="image/svg+xml",
+        type="primary"
+    )
+    # The PNG is only rendered when asked for, then served from the render cache
+    if st.toggle("Also offer a PNG download", value=False, key="png_download"):
+        png_bytes, error_message = generate_uml_diagram(plantuml_code, plantuml_jar_path, output_format='png')
+        if png_bytes:
+            st.download_button(label="Download PNG", data=png_bytes, file_name="diagram.png", mime="image/png")
+        else:
+            st.error(f"Failed to render the PNG: {error_message}")
     return btn
 
-# Function to generate a plan using OpenAI
+# Function to generate several candidates concurrently and keep the first one that renders
+@traced('best_of_n')
+def generate_best_of_n(input_text):
+    instruction = compile_instruction_prompt(selected_diagram_type, include_title, use_aws_orange_theme, use_note, use_illustration)
+    current_span().set(prompt_hash=instruction.prompt_hash)
+    cached_code = response_cache.get(instruction.prompt_hash, selected_diagram_type, input_text, model=llm.model)
+    if cached_code:
+        return cached_code
+    try:
+        plantuml_code, image_bytes, _ = run_sync(first_valid_diagram(
+            best_of_n_candidates(llm, candidate_count),
+            instruction.text,
+            input_text,
+            render=lambda code: generate_uml_diagram(code, plantuml_jar_path=plantuml_jar_path),
+            max_tokens=budget_governor.max_tokens(selected_diagram_type),
+            diagram_type=selected_diagram_type
+        ))
+    except BudgetExceeded:
+        # Handled by the caller, which must not fall back to another generation
+        raise
+    except Exception as e:
+        st.error(f"An error occurred with the LLM API: {e}")
+        return None
+    if image_bytes:
+        budget_governor.record_output(selected_diagram_type, plantuml_code)
+    return plantuml_code
+
+# Function to cache the code of a request once it rendered, or drop it from the cache when it failed
+def cache_rendered_code(nl_instruction, plantuml_code, rendered):
+    instruction = compile_instruction_prompt(selected_diagram_type, include_title, use_aws_orange_theme, use_note, use_illustration)
+    if rendered:
+        response_cache.put(instruction.prompt_hash, selected_diagram_type, nl_instruction, plantuml_code, model=llm.model)
+    else:
+        response_cache.discard(instruction.prompt_hash, selected_diagram_type, nl_instruction, model=llm.model)
+
+# Function to generate a plan using the LLM
+@traced('plan')
 def generate_plan(nl_instruction):
+    cached_plan = response_cache.get(plan_message, 'plan', nl_instruction, model=llm.model)
+    current_span().set(provider=llm.provider, cache_hit=bool(cached_plan))
+    if cached_plan:
+        return cached_plan
     try:
-        openai_response = openai.chat.completions.create(
-            model="gpt-4-turbo",
-            messages=[
-                {"role": "system", "content": "Generate a brief plan based on the user's description. This plan will be used to create a diagram. Keep the plan concise and relevant."},
-                {"role": "user", "content": nl_instruction}
-            ],
-            temperature=0.5,
-            stream=False,
-        )
-        return openai_response.choices[0].message.content
+        plan = run_sync(llm.complete(plan_message, nl_instruction, temperature=0.5))
+        if plan:
+            response_cache.put(plan_message, 'plan', nl_instruction, plan, model=llm.model)
+        return plan
+    except BudgetExceeded as e:
+        st.warning(str(e))
+        return None
     except Exception as e:
-        st.error(f"An error occurred with the OpenAI API: {e}")
+        st.error(f"An error occurred with the LLM API: {e}")
         return None
     
+# Function to generate, render and repair a diagram; generation.generate_diagram is the headless
+# version of this loop, kept separate because every step here updates the page
 def process_and_generate_diagrams(input_text):
     retry_count = 0
     error_message = None
     while retry_count < 3:
-        with st.spinner(text="🤔 Thinking on how to draw this plan..."):
-            generated_code = nl_to_plantuml(
-                input_text,
-                selected_diagram_type,
-                include_title,
-                use_aws_orange_theme,
-                use_note,
-                use_illustration,
-                error_details=error_message,
-                failed_code=st.session_state['plantuml_code'] if error_message else None
-            )
-        if generated_code:
-            valid_plantuml_code = extract_plantuml_code(generated_code)
-            if valid_plantuml_code:
-                st.session_state['plantuml_code'] = valid_plantuml_code
-                st.session_state['nl_instruction'] = input_text
+        with span('attempt', retry=retry_count):
+            generated_code = None
+            if error_message:
+                # Patch only the failing lines instead of regenerating the whole diagram
+                with st.spinner(text="🔧 Fixing the diagram code..."):
+                    generated_code = repair_plantuml(st.session_state['plantuml_code'], error_message)
+            elif candidate_count > 1:
+                # Race several candidates; the first one that renders wins and the others are cancelled
+                with st.spinner(text=f"🤔 Drawing {candidate_count} candidates in parallel..."):
+                    try:
+                        generated_code = generate_best_of_n(input_text)
+                    except BudgetExceeded as e:
+                        st.warning(str(e))
+                        break
+            if not generated_code:
+                # Placeholder showing the code while it is being generated
+                live_code = st.empty()
+                with st.spinner(text="🤔 Thinking on how to draw this plan..."):
+                    generated_code = nl_to_plantuml(
+                        input_text,
+                        selected_diagram_type,
+                        include_title,
+                        use_aws_orange_theme,
+                        use_note,
+                        use_illustration,
+                        error_details=error_message,
+                        failed_code=st.session_state['plantuml_code'] if error_message else None,
+                        on_partial=live_code.code if stream_code else None
+                    )
+                live_code.empty()
+            if generated_code:
+                with span('extract'):
+                    valid_plantuml_code = extract_plantuml_code(generated_code, selected_diagram_type)
+                if valid_plantuml_code:
+                    st.session_state['plantuml_code'] = valid_plantuml_code
+                    st.session_state['nl_instruction'] = input_text
                 
-                output_puml_file, output_png_file, error_message = generate_uml_diagram(
-                    st.session_state['plantuml_code'], output_dir=output_dir, plantuml_jar_path=plantuml_jar_path
-                )
-                if output_png_file:
-                    st.toast("Successfully generated your diagram", icon='✅')
-                    # Display the generated diagram
-                    st.image(str(output_png_file), caption='Diagram generated by Peter', use_column_width=False)
+                    image_bytes, error_message = generate_uml_diagram(
+                        st.session_state['plantuml_code'], plantuml_jar_path=plantuml_jar_path
+                    )
+                    # Repaired code replaces the broken answer in the cache as soon as it renders
+                    cache_rendered_code(input_text, st.session_state['plantuml_code'], rendered=bool(image_bytes))
+                    if image_bytes:
+                        st.toast("Successfully generated your diagram", icon='✅')
+                        # Display the generated diagram
+                        show_diagram(image_bytes, caption='Diagram generated by Peter')
                     
-                    # Provide a download button for the image
-                    get_image_download_link(str(output_png_file))
-
-                    if display_code:
-                        st.text("🥳 Here's your PlantUML code if you need to generate this graph else where:")
-                        plantuml_code = st.code(
-                            body=st.session_state['plantuml_code'],
-                            line_numbers=True
-                        )
+                        # Provide a download button for the image
+                        get_image_download_link(image_bytes, st.session_state['plantuml_code'])
+
+                        if display_code:
+                            st.text("🥳 Here's your PlantUML code if you need to generate this graph else where:")
+                            plantuml_code = st.code(
+                                body=st.session_state['plantuml_code'],
+                                line_numbers=True
+                            )
                         
-                    break  # Exit loop on success
+                        return True  # Exit on success
+                    st.error("Generated PlantUML code failed to compile. Retrying...")
+                    retry_count += 1
+                else:
+                    st.error("No valid PlantUML code block found. Retrying...")
+                    retry_count += 1
             else:
-                st.error("No valid PlantUML code block found. Retrying...")
-                retry_count += 1
-        else:
-            st.error("Failed to convert to PlantUML code.")
-            break  # Exit loop on conversion failure
+                st.error("Failed to convert to PlantUML code.")
+                break  # Exit loop on conversion failure
+    return False
+
+# Function to plan while a speculative diagram is drafted straight from the instruction
+def plan_with_draft(nl_instruction):
+    draft_area = st.empty()
+    draft_code = None
+    draft_checked = False
+
+    # Worker threads share this session's script context so st.error still reaches the page
+    script_ctx = get_script_run_ctx()
+    pool = ThreadPoolExecutor(max_workers=2, initializer=add_script_run_ctx, initargs=(None, script_ctx))
+    # Each task runs in a copy of this thread's context, so its spans join the trace of the click
+    plan_future = pool.submit(contextvars.copy_context().run, generate_plan, nl_instruction)
+    draft_future = pool.submit(
+        contextvars.copy_context().run,
+        nl_to_plantuml,
+        nl_instruction,
+        selected_diagram_type,
+        include_title,
+        use_aws_orange_theme,
+        use_note,
+        use_illustration
+    )
+    # Don't wait for a draft that loses the race against the plan; its future stays the fallback
+    pool.shutdown(wait=False)
+
+    # Function to render the finished draft and show it, returning its code when it renders
+    def show_draft(generated_code):
+        draft_code = extract_plantuml_code(generated_code, selected_diagram_type) if generated_code else None
+        if not draft_code:
+            return None
+        image_bytes, _ = generate_uml_diagram(draft_code, plantuml_jar_path=plantuml_jar_path)
+        cache_rendered_code(nl_instruction, draft_code, rendered=bool(image_bytes))
+        if not image_bytes:
+            return None
+        with draft_area.container():
+            show_diagram(image_bytes, caption='Draft diagram generated by Peter while planning')
+        return draft_code
+
+    with st.spinner(text="🤔 Planning..."):
+        for future in as_completed([plan_future, draft_future]):
+            if future is plan_future:
+                break
+            # Show the draft as soon as it renders, even if the plan is still being written
+            draft_code = show_draft(draft_future.result())
+            draft_checked = True
+        plan = plan_future.result()
+
+    if plan:
+        st.session_state['plan'] = plan
+        st.subheader('Done thinking ✅ Here is the plan:')
+        st.write(plan)
+        if process_and_generate_diagrams(plan):
+            # The planned diagram replaces the draft
+            draft_area.empty()
+            return
+    else:
+        st.error("Failed to generate a plan.")
+
+    if not draft_checked:
+        # The draft lost the race against the plan, but it was paid for: it is the fallback,
+        # whether it finished in the meantime or is still being written
+        with st.spinner(text="🤔 Finishing the draft diagram..."):
+            draft_code = show_draft(draft_future.result())
+    if draft_code:
+        # Keep the draft when the planned diagram could not be produced
+        st.session_state['plantuml_code'] = draft_code
+        st.session_state['nl_instruction'] = nl_instruction
+        st.info("Keeping the draft diagram.")
 
 # Streamlit application layout
 st.title('Agent Peter - Diagram Generator')
@@ -215,16 +378,45 @@ st.markdown('**How to use Peter**', help='''1. Select the type of diagram you wa
 # Sidebar content
 with st.sidebar:
     st.header("Agent controls:")
+    # Auto routes every request to the fastest healthy provider, with failover
+    provider_choice = st.selectbox("LLM provider:", ["Auto (fastest healthy)"] + list(providers), index=0)
+    llm = providers.get(provider_choice, router)
     # Select box for choosing diagram type
-    selected_diagram_type = st.selectbox("Choose diagram type:", df_diagrams['diagram_type'].to_list(), index=0)
+    selected_diagram_type = st.selectbox("Choose diagram type:", diagram_type_names, index=0)
 
     # Toggles for instruction message content
     use_planning = st.toggle("Enable Planning Mode", value=True)
+    draft_while_planning = st.toggle("Draft a diagram while planning", value=True, disabled=not use_planning)
     display_code = st.toggle("Display generated diagram code", value=False)
+    stream_code = st.toggle("Show code while generating", value=True)
+    candidate_count = st.slider("Parallel candidates", min_value=1, max_value=4, value=1, help="Generate several diagrams at once and keep the first one that renders.")
+    # Users can lower the token budget of their requests, never raise it above the operator limit.
+    # Empty means the operator limit, or no limit at all when the operator disabled it.
+    request_token_limit = st.number_input(
+        "Token budget per request:",
+        min_value=min(min_max_tokens, request_token_budget) if request_token_budget else min_max_tokens,
+        max_value=request_token_budget or None,
+        value=request_token_budget or None,
+        step=1000,
+        placeholder="No limit",
+        help="Planning, generation and every retry of one click share this budget."
+    )
+    token_usage = st.empty()
     include_title = st.checkbox("Include a title",value=True)
     use_aws_orange_theme = st.checkbox("Use aws-orange theme", value=True)
     use_illustration = st.checkbox("Use grouping", value=True)
     use_note = st.checkbox("Use notes", value=True)
+    # SVG stays small and sharp for large diagrams; PNG is only rendered when downloaded.
+    # The default follows the render profile of the selected diagram type.
+    diagram_formats = ['svg', 'png']
+    diagram_format = st.radio(
+        "Diagram format:",
+        diagram_formats,
+        index=diagram_formats.index(catalog[selected_diagram_type].render_format),
+        format_func=str.upper,
+        horizontal=True
+    )
+    show_debug = st.toggle("Show stage timings", value=False, help="Debug panel with the duration of each stage of the last request.")
 
 # Text area for user to enter natural language instructions
 nl_instruction = st.text_area(
@@ -239,39 +431,47 @@ convert_button = st.button("Generate diagram", type="primary",use_container_widt
 
 # When the button is clicked, convert the natural language to PlantUML code
 if convert_button:
-    if use_planning:
-        # Generate plan and directly use it for conversion
-        with st.spinner(text="🤔 Planning..."):
-            plan = generate_plan(nl_instruction)
-        if plan:
-            st.session_state['plan'] = plan
-            st.subheader('Done thinking ✅ Here is the plan:') 
-            st.write(plan)
-            process_and_generate_diagrams(plan)
+    with span('request', diagram_type=selected_diagram_type, planning=use_planning, candidates=candidate_count) as request_span, \
+            request_budget(session_budget, token_limit=request_token_limit) as budget:
+        # Remember the trace of this click for the debug panel
+        st.session_state['last_trace_id'] = request_span.trace_id
+        if use_planning and draft_while_planning:
+            # Run the plan and a direct draft concurrently so a diagram shows up before the plan is done
+            plan_with_draft(nl_instruction)
+        elif use_planning:
+            # Generate plan and directly use it for conversion
+            with st.spinner(text="🤔 Planning..."):
+                plan = generate_plan(nl_instruction)
+            if plan:
+                st.session_state['plan'] = plan
+                st.subheader('Done thinking ✅ Here is the plan:') 
+                st.write(plan)
+                process_and_generate_diagrams(plan)
+            else:
+                st.error("Failed to generate a plan.")
         else:
-            st.error("Failed to generate a plan.")
-    else:
-        # Proceed with direct conversion using the natural language instruction
-        process_and_generate_diagrams(nl_instruction)
+            # Proceed with direct conversion using the natural language instruction
+            process_and_generate_diagrams(nl_instruction)
+        request_span.set(tokens=budget.tokens_used, llm_calls=budget.calls)
 
 else:
     # Check if there is PlantUML code in the session state before creating the text_area
     if st.session_state['plantuml_code']:
         # Generate and display the diagram
-        output_puml_file, output_png_file, error_message = generate_uml_diagram(
-            st.session_state['plantuml_code'], output_dir=output_dir, plantuml_jar_path=plantuml_jar_path
+        image_bytes, error_message = generate_uml_diagram(
+            st.session_state['plantuml_code'], plantuml_jar_path=plantuml_jar_path
         )
-        if output_png_file:
+        if image_bytes:
             # Conditionally display the plan if it exists
             if 'plan' in st.session_state:
                 st.subheader('Done thinking! Here is the plan:')
                 st.write(st.session_state['plan'])
 
             # Display the generated diagram
-            st.image(str(output_png_file), caption='Diagram generated by Peter', use_column_width=False)
+            show_diagram(image_bytes, caption='Diagram generated by Peter')
             
             # Provide a download button for the image
-            get_image_download_link(str(output_png_file))
+            get_image_download_link(image_bytes, st.session_state['plantuml_code'])
 
             if display_code:
                 st.text("🥳 Here's your PlantUML code if you need to generate this graph else where:")
@@ -281,4 +481,25 @@ else:
                 )
             
 
+# Tokens used by this session, shown once the request is done
+token_usage.caption(
+    f"Tokens used in this session: {session_budget.tokens_used:,}"
+    + (f" of {session_budget.token_limit:,}" if session_budget.token_limit else "")
+)
 
+# Debug panel: where the time of the last request of this session went, stage by stage
+if show_debug and st.session_state.get('last_trace_id'):
+    spans = get_telemetry().trace(st.session_state['last_trace_id'])
+    depths = {}
+    rows = []
+    for traced_span in spans:
+        depths[traced_span.span_id] = depths.get(traced_span.parent_id, -1) + 1
+        rows.append({
+            'stage': "· " * depths[traced_span.span_id] + traced_span.name,
+            'ms': round(traced_span.duration * 1000, 1),
+            'status': traced_span.status,
+            'attributes': ", ".join(f"{key}={value}" for key, value in traced_span.attributes.items()),
+        })
+    with st.sidebar.expander("Stage timings", expanded=True):
+        st.dataframe(rows, hide_index=True)
+        st.download_button("Download Prometheus metrics", get_telemetry().prometheus_text(), file_name="metrics.prom", mime="text/plain")
@@ -1,153 +1,140 @@
 import streamlit as st
-import subprocess
-import os
-import re
-from pathlib import Path
-from anthropic import Anthropic
-import tempfile
-from data import diagrams
-import glob
-import pandas as pd
-
-# import the list of supported diagrams
-df_diagrams = pd.DataFrame(diagrams)
-
-# Directory for storing output diagrams
-output_dir = Path('./diagrams')
+from data import catalog, diagram_type_names
+from llm_budget import BudgetExceeded, SessionBudget, get_budget_governor, request_budget
+from llm_client import get_client, iterate_sync, run_sync
+from plantuml_streaming import collect_until_plantuml_end, extract_plantuml_code
+from prompts import compile_instruction_prompt
+from plantuml_repair import apply_repair_patch, build_repair_prompt, repair_system_message
+from render_cache import RenderCache
+from render_pipeline import render_diagram
+from telemetry import current_span, traced
+from edit_session import EditSession
+from llm_cache import get_response_cache
 
 # Path to the PlantUML .jar file
 plantuml_jar_path = './plantuml.jar'
 
-# Connect to Anthropic Services
-client = Anthropic(
+# Model used to generate the PlantUML code
+anthropic_model = "claude-3-sonnet-20240229"
+
+# Cache of rendered diagrams shared by every session
+render_cache = RenderCache('./.render_cache')
+
+# Cache of LLM responses shared by every session
+response_cache = get_response_cache()
+
+# Token and time budgets of the LLM calls; limits are set through the LLM_* environment variables
+budget_governor = get_budget_governor()
+
+# Connect to Anthropic Services through the shared async client; ANTHROPIC_BASE_URL can point it at a local stub server
+llm = get_client(
+    'anthropic',
     api_key=st.secrets["ANTHROPIC_API_KEY"],
+    model=anthropic_model,
+    base_url=st.secrets.get("ANTHROPIC_BASE_URL")
 )
 
+# Background renderer of the code edits of this session
+if 'edit_session' not in st.session_state:
+    st.session_state['edit_session'] = EditSession(lambda code: generate_uml_diagram(code, plantuml_jar_path=plantuml_jar_path))
+edit_session = st.session_state['edit_session']
+
 # Initialize session state for PlantUML code
 if 'plantuml_code' not in st.session_state:
     st.session_state['plantuml_code'] = ""
 
+# Tokens used by this session, against the session budget
+if 'session_budget' not in st.session_state:
+    st.session_state['session_budget'] = SessionBudget()
+session_budget = st.session_state['session_budget']
+
 # Function to convert natural language instruction to PlantUML code using Anthropic
-def nl_to_plantuml(nl_instruction, diagram_type, include_title, use_aws_orange_theme, use_note, use_illustration, error_details=None, failed_code=None):
-    example = df_diagrams[df_diagrams['diagram_type'] == diagram_type]['example'].iloc[0]
-    if diagram_type == "Let AI decide best Diagram":
-        diagram_type = 'most appropriate diagram'
-    # Construct the instruction message based on toggles
-    instruction_message = f"You are a professional PlantUML coder."
-    if include_title:
-        instruction_message += " Include a title."
-    if use_aws_orange_theme:
-        instruction_message += " Use aws-orange theme. Syntax: !theme aws-orange"
-    if use_note:
-        instruction_message += " Use note if needed to explain more details."
-    if use_illustration:
-        instruction_message += " Use group or card if needed."
-    instruction_message += f''' You MUST Output PlantUML code for a {diagram_type} only and explain nothing.
-    For example the code will start with: {example}.
-    '''
+@traced('generate')
+def nl_to_plantuml(nl_instruction, diagram_type, include_title, use_aws_orange_theme, use_note, use_illustration, error_details=None, failed_code=None, on_partial=None):
+    # Construct the instruction message based on toggles; it is compiled once per type and options
+    instruction = compile_instruction_prompt(diagram_type, include_title, use_aws_orange_theme, use_note, use_illustration)
+    instruction_message = instruction.text
+    # Sized after the past answers of this diagram type; a retry gets the full default
+    max_tokens = budget_governor.max_tokens(diagram_type, retry=bool(error_details))
+    current_span().set(diagram_type=diagram_type, provider=llm.provider, model=anthropic_model, prompt_hash=instruction.prompt_hash, retry=bool(error_details), cache_hit=False, max_tokens=max_tokens)
 
     if error_details and failed_code:
-        # nl_instruction += f"\n\nPrevious error details: {error_details}\n\nPlantUML code from diagrams\output.puml:\n{failed_code}\n"
-        # nl_instruction += " Why this PlantUML code doesn't run? Analyze the code for any syntax error and return a corrected PlantUML code."
-        nl_instruction += " You must use Sequence Diagram for this request."
+        # The previous answer for this instruction failed, so it must not be served from the cache again
+        response_cache.discard(instruction.prompt_hash, diagram_type, nl_instruction, model=anthropic_model)
+        # A targeted repair was not possible, so regenerate while pointing at the previous mistake
+        nl_instruction += f"\n\nThe previous PlantUML code failed with this error, do not repeat it:\n{error_details}"
+    else:
+        # Identical requests with identical options are answered from the response cache
+        cached_code = response_cache.get(instruction.prompt_hash, diagram_type, nl_instruction, model=anthropic_model)
+        if cached_code:
+            current_span().set(cache_hit=True, output_chars=len(cached_code))
+            if on_partial:
+                on_partial(cached_code)
+            return cached_code
    
     try:
         # Use the Anthropic API to generate a response
-        claude_response = client.messages.create(
-            model="claude-3-sonnet-20240229",
-            max_tokens=4000,
-            temperature=0.5,
-            system=instruction_message,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": nl_instruction
-                        }
-                    ]
-                }
-            ]
-        )    
-        plantuml_code = claude_response.content[0].text
+        text_chunks = iterate_sync(llm.stream(instruction_message, nl_instruction, temperature=0.5, max_tokens=max_tokens))
+        try:
+            # Stop reading as soon as the @endXXX tag arrives
+            plantuml_code, _ = collect_until_plantuml_end(text_chunks, on_partial=on_partial)
+        finally:
+            # Closing the stream cancels the rest of the response, so trailing prose is never generated
+            text_chunks.close()
+        current_span().set(output_chars=len(plantuml_code))
+        if extract_plantuml_code(plantuml_code, diagram_type):
+            budget_governor.record_output(diagram_type, plantuml_code)
+        # Cached by cache_rendered_code once it renders, so a broken answer is never served again
         return plantuml_code
+    except BudgetExceeded as e:
+        st.warning(str(e))
+        return None
     except Exception as e:
         st.error(f"An error occurred with the Anthropic API: {e}")
         return None
 
-# Function to generate UML diagram from PlantUML code
-def generate_uml_diagram(plantuml_code, output_dir, plantuml_jar_path):
-    retries = 2
-    error_message = None
-
-    output_dir = Path(output_dir)
-    output_dir.mkdir(parents=True, exist_ok=True)  # Ensure output directory exists
-
-    # Define the path for the .puml file
-    output_puml_file = output_dir / "output.puml"
-
-    # Write the PlantUML code to the .puml file
-    with open(output_puml_file, 'w') as file:
-        file.write(plantuml_code)
-
-    while retries >= 0:
-        try:
-            subprocess_result = subprocess.run(
-                ['java',
-                 '-jar', plantuml_jar_path,
-                 str(output_puml_file)],
-                capture_output=True, text=True
-            )
-
-            # Find the generated PNG file
-            png_files = list(output_dir.glob('*.png'))
-            if subprocess_result.returncode == 0 and png_files:
-                # Assume the newest PNG file is the one we just created
-                generated_png_file = max(png_files, key=os.path.getctime)
-                output_png_file = output_dir / "output.png"
-                # Rename the file to output.png
-                generated_png_file.rename(output_png_file)
-                return str(output_puml_file), str(output_png_file), None
-            else:
-                error_message = "Failed to create the output diagram or PlantUML error."
-                if subprocess_result.stderr:
-                    error_message = subprocess_result.stderr
-                retries -= 1
-        except Exception as e:
-            error_message = f"An error occurred: {str(e)}"
-            retries -= 1
-
-    return None, None, error_message
+# Function to fix only the failing lines of PlantUML code using Anthropic
+@traced('repair')
+def repair_plantuml(failed_code, error_details):
+    repair_prompt = build_repair_prompt(failed_code, error_details)
+    if not repair_prompt:
+        return None
+    try:
+        patch_text = run_sync(llm.complete(repair_system_message, repair_prompt, temperature=0, max_tokens=1000))
+        return apply_repair_patch(failed_code, patch_text)
+    except BudgetExceeded:
+        # Reported by the regeneration that follows
+        return None
+    except Exception as e:
+        st.error(f"An error occurred with the Anthropic API: {e}")
+        return None
 
-def extract_plantuml_code(full_code):
-    """
-    Extracts the PlantUML code between @startXXX and @endXXX tags.
-    
-    Args:
-    - full_code (str): The full PlantUML code including unwanted text.
-    
-    Returns:
-    - str: The extracted PlantUML code or None if no valid code block is found.
-    """
-    # Regular expression to find blocks starting with @start and ending with @end
-    pattern = re.compile(r"@start\w+.*?@end\w+", re.DOTALL)
-    match = pattern.search(full_code)
-    
-    if match:
-        return match.group(0)  # Return the matched block, including start and end tags
+# Function to cache the code of a request once it rendered, or drop it from the cache when it failed
+def cache_rendered_code(nl_instruction, plantuml_code, rendered):
+    instruction = compile_instruction_prompt(selected_diagram_type, include_title, use_aws_orange_theme, use_note, use_illustration)
+    if rendered:
+        response_cache.put(instruction.prompt_hash, selected_diagram_type, nl_instruction, plantuml_code, model=anthropic_model)
     else:
-        return None  # Return None if no valid block is found
+        response_cache.discard(instruction.prompt_hash, selected_diagram_type, nl_instruction, model=anthropic_model)
+
+# Function to generate UML diagram from PlantUML code, entirely in memory
+def generate_uml_diagram(plantuml_code, plantuml_jar_path):
+    return render_diagram(
+        plantuml_code,
+        plantuml_jar_path,
+        render_cache=render_cache,
+        timeout=catalog[selected_diagram_type].render_timeout,
+        diagram_type=selected_diagram_type
+    )
 
 # Function to create a download link for the image
-def get_image_download_link(img_path):
-    with open(img_path, "rb") as file:
-        btn = st.download_button(
-            label="Download image",
-            data=file,
-            file_name="diagram.png",
-            mime="image/png"
-        )
+def get_image_download_link(image_bytes):
+    btn = st.download_button(
+        label="Download image",
+        data=image_bytes,
+        file_name="diagram.png",
+        mime="image/png"
+    )
     return btn
 
 # Streamlit application layout
@@ -158,13 +145,14 @@ st.markdown('**How to use Peter**', help='''1. Select the type of diagram you wa
 with st.sidebar:
     st.header("Agent controls:")
     # Select box for choosing diagram type
-    selected_diagram_type = st.selectbox("Choose diagram type:", df_diagrams['diagram_type'].to_list(), index=0)
+    selected_diagram_type = st.selectbox("Choose diagram type:", diagram_type_names, index=0)
 
     # Toggles for instruction message content
     include_title = st.toggle("Include a title",value=True)
     use_aws_orange_theme = st.toggle("Use aws-orange theme", value=True)
     use_illustration = st.toggle("Use grouping", value=True)
     use_note = st.toggle("Use notes", value=True)
+    stream_code = st.toggle("Show code while generating", value=True)
 
 # Text area for user to enter natural language instructions
 nl_instruction = st.text_area(
@@ -182,66 +170,81 @@ plantuml_code_placeholder = st.empty()
 
 # When the button is clicked, convert the natural language to PlantUML code
 if convert_button:
-    retry_count = 0
-    error_message = None
-    while retry_count < 5:
-        with st.spinner(text="🤔 Thinking deeply about your requirements..."):
-            generated_code = nl_to_plantuml(
-                nl_instruction,
-                selected_diagram_type,
-                include_title,
-                use_aws_orange_theme,
-                use_note,
-                use_illustration,
-                error_details=error_message,
-                failed_code=st.session_state['plantuml_code'] if error_message else None
-            )
+    # Every call of this click, retries included, shares one token and time budget
+    with request_budget(session_budget):
+        retry_count = 0
+        error_message = None
+        while retry_count < 5:
+            generated_code = None
+            if error_message:
+                # Patch only the failing lines instead of regenerating the whole diagram
+                with st.spinner(text="🔧 Fixing the diagram code..."):
+                    generated_code = repair_plantuml(st.session_state['plantuml_code'], error_message)
+            if not generated_code:
+                # Placeholder showing the code while it is being generated
+                live_code = st.empty()
+                with st.spinner(text="🤔 Thinking deeply about your requirements..."):
+                    generated_code = nl_to_plantuml(
+                        nl_instruction,
+                        selected_diagram_type,
+                        include_title,
+                        use_aws_orange_theme,
+                        use_note,
+                        use_illustration,
+                        error_details=error_message,
+                        failed_code=st.session_state['plantuml_code'] if error_message else None,
+                        on_partial=live_code.code if stream_code else None
+                    )
+                live_code.empty()
             
-        if generated_code:
-            valid_plantuml_code = extract_plantuml_code(generated_code)
-            if valid_plantuml_code:
-                st.session_state['plantuml_code'] = valid_plantuml_code
-                st.session_state['nl_instruction'] = nl_instruction
+            if generated_code:
+                valid_plantuml_code = extract_plantuml_code(generated_code, selected_diagram_type)
+                if valid_plantuml_code:
+                    st.session_state['plantuml_code'] = valid_plantuml_code
+                    st.session_state['nl_instruction'] = nl_instruction
 
-                if error_message:
-                    widget_key = "plantuml_code_textarea_retry_{}".format(retry_count)
-                    print("------------------------------- Retry number: {}".format(retry_count))
-                    plantuml_code_placeholder.empty()
-                    plantuml_code = plantuml_code_placeholder.text_area(
-                        "You can edit the PlantUML code if you wish 👇, diagram will be updated accordingly 🥳:",
-                        value=st.session_state['plantuml_code'],
-                        height=300,
-                        key= widget_key
-                    )
-                else:
-                    widget_key='plantuml_code_textarea'
-                    plantuml_code_placeholder.empty()
-                    plantuml_code = plantuml_code_placeholder.text_area(
-                        "You can edit the PlantUML code if you wish 👇, diagram will updated accordingly 🥳:",
-                        value=st.session_state['plantuml_code'],
-                        height=300,
-                        key=widget_key
-                    )
+                    if error_message:
+                        widget_key = "plantuml_code_textarea_retry_{}".format(retry_count)
+                        plantuml_code_placeholder.empty()
+                        plantuml_code = plantuml_code_placeholder.text_area(
+                            "You can edit the PlantUML code if you wish 👇, diagram will be updated accordingly 🥳:",
+                            value=st.session_state['plantuml_code'],
+                            height=300,
+                            key= widget_key
+                        )
+                    else:
+                        widget_key='plantuml_code_textarea'
+                        plantuml_code_placeholder.empty()
+                        plantuml_code = plantuml_code_placeholder.text_area(
+                            "You can edit the PlantUML code if you wish 👇, diagram will updated accordingly 🥳:",
+                            value=st.session_state['plantuml_code'],
+                            height=300,
+                            key=widget_key
+                        )
 
-                output_puml_file, output_png_file, error_message = generate_uml_diagram(
-                    st.session_state['plantuml_code'], output_dir=output_dir, plantuml_jar_path=plantuml_jar_path
-                )
+                    image_bytes, error_message = generate_uml_diagram(
+                        st.session_state['plantuml_code'], plantuml_jar_path=plantuml_jar_path
+                    )
+                    # Repaired code replaces the broken answer in the cache as soon as it renders
+                    cache_rendered_code(nl_instruction, st.session_state['plantuml_code'], rendered=bool(image_bytes))
                 
-            if output_png_file:
-                st.toast("Successfully generated your diagram",icon='✅')
-                # Display the generated diagram
-                st.image(str(output_png_file), caption='Diagram generated by Peter', use_column_width=False)
+                if image_bytes:
+                    st.toast("Successfully generated your diagram",icon='✅')
+                    # Edits of the code start from this diagram
+                    edit_session.set_rendered(st.session_state['plantuml_code'], image_bytes)
+                    # Display the generated diagram
+                    st.image(image_bytes, caption='Diagram generated by Peter', use_column_width=False)
                 
-                # Provide a download button for the image
-                get_image_download_link(str(output_png_file))
+                    # Provide a download button for the image
+                    get_image_download_link(image_bytes)
                 
-                break  # Exit loop on success
+                    break  # Exit loop on success
+                else:
+                    st.error("Generated PlantUML code failed to compile. Retrying...")
+                    retry_count += 1
             else:
-                st.error("Generated PlantUML code failed to compile. Retrying...")
-                retry_count += 1
-        else:
-            st.error("Failed to convert to PlantUML code.")
-            break  # Exit loop on conversion failure
+                st.error("Failed to convert to PlantUML code.")
+                break  # Exit loop on conversion failure
 
 else:
     # Check if there is PlantUML code in the session state before creating the text_area
@@ -254,16 +257,22 @@ else:
         )
         # Update the session state when the user edits the code
         st.session_state['plantuml_code'] = plantuml_code
-        
+
+        # Render the edit in the background; edits that only touch comments or whitespace are skipped
+        edit_session.submit(plantuml_code)
+
         st.subheader('Edited Diagram')
-        # Generate and display the diagram
-        output_puml_file, output_png_file, error_message = generate_uml_diagram(
-            st.session_state['plantuml_code'], output_dir=output_dir, plantuml_jar_path=plantuml_jar_path
-        )
-        if output_png_file:
-            # Display the generated diagram
-            st.image(str(output_png_file), caption='Diagram generated by Peter', use_column_width=False)
-            
+        # The last good diagram stays on screen while the edit renders
+        if edit_session.image_bytes:
+            st.image(edit_session.image_bytes, caption='Diagram generated by Peter', use_column_width=False)
+
             # Provide a download button for the image
-            get_image_download_link(str(output_png_file))
-        
+            get_image_download_link(edit_session.image_bytes)
+
+        if edit_session.pending():
+            with st.spinner(text="Updating the diagram..."):
+                edit_session.wait(timeout=60)
+            # Show the new diagram; a newer edit interrupts this run anyway
+            st.rerun()
+        elif edit_session.error_message:
+            st.error(f"Your last edit does not render, showing the last working diagram: {edit_session.error_message}")
@@ -0,0 +1,111 @@
+import concurrent.futures
+import contextvars
+import threading
+import time
+
+from plantuml_validator import strip_diagram_comments
+
+# Threads rendering user edits, shared by every session of the process
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='edit-render')
+
+
+def edit_key(plantuml_code):
+    """
+    Returns the PlantUML source without comments, blank lines or trailing whitespace.
+
+    Two sources with the same key draw the same diagram, so an edit that keeps the key,
+    such as a new comment or blank line, needs no render. Indentation is kept: it is part
+    of the syntax of YAML, JSON and markdown-style mind maps. JSON and YAML have no comments,
+    so a line starting with ' is kept there.
+    """
+    return "\n".join(line for line in strip_diagram_comments(plantuml_code.splitlines(), keep_indent=True) if line)
+
+
+class EditSession:
+    """
+    Renders the code edits of one user in the background, keeping the last good image.
+
+    An edit is rendered after `debounce` seconds without a newer edit, and the result of an
+    edit that was overtaken by a newer one is dropped. Edits that do not change the diagram
+    are not rendered at all.
+    """
+
+    def __init__(self, render, debounce=0.3):
+        self.render = render
+        self.debounce = debounce
+        self.image_bytes = None
+        self.error_message = None
+        self._rendered_key = None
+        self._pending_key = None
+        self._future = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def set_rendered(self, plantuml_code, image_bytes):
+        """
+        Records a diagram rendered elsewhere, such as the one just generated.
+        """
+        with self._lock:
+            self._generation += 1
+            self._pending_key = None
+            self._rendered_key = edit_key(plantuml_code)
+            self.image_bytes = image_bytes
+            self.error_message = None
+
+    def submit(self, plantuml_code):
+        """
+        Starts rendering an edit in the background unless it draws the same diagram.
+
+        Returns:
+        - bool: True when a render was started.
+        """
+        key = edit_key(plantuml_code)
+        with self._lock:
+            if key == self._pending_key:
+                return False
+            if key == self._rendered_key:
+                # Back to the diagram on screen: forget the edit in flight
+                self._generation += 1
+                self._pending_key = None
+                return False
+            self._generation += 1
+            self._pending_key = key
+            generation = self._generation
+        self._future = _executor.submit(contextvars.copy_context().run, self._render, plantuml_code, key, generation)
+        return True
+
+    def _render(self, plantuml_code, key, generation):
+        time.sleep(self.debounce)
+        if generation != self._generation:
+            # A newer edit arrived during the debounce
+            return
+        try:
+            image_bytes, error_message = self.render(plantuml_code)
+        except Exception as e:
+            image_bytes, error_message = None, f"An error occurred: {str(e)}"
+        with self._lock:
+            if generation != self._generation:
+                return
+            if image_bytes:
+                self.image_bytes = image_bytes
+            self.error_message = error_message
+            self._rendered_key = key
+            self._pending_key = None
+
+    def pending(self):
+        return self._pending_key is not None
+
+    def wait(self, timeout=None):
+        """
+        Waits for the render in flight, if any.
+
+        Returns:
+        - bool: True when no render is pending anymore.
+        """
+        future = self._future
+        if future is not None:
+            try:
+                future.result(timeout)
+            except concurrent.futures.TimeoutError:
+                pass
+        return not self.pending()
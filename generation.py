@@ -0,0 +1,155 @@
+import asyncio
+import contextvars
+import time
+
+from llm_budget import BudgetExceeded
+from plantuml_repair import apply_repair_patch, build_repair_prompt, repair_system_message
+from plantuml_streaming import complete_block_pattern, extract_plantuml_code
+from telemetry import span
+
+# Temperatures given to the parallel candidates, in order
+candidate_temperatures = [0.5, 0.2, 0.8, 1.0]
+
+
+async def stream_plantuml(client, system_message, nl_instruction, temperature=0.5, max_tokens=None):
+    """
+    Streams a completion and stops reading as soon as a complete PlantUML block has arrived.
+    """
+    started_at = time.perf_counter()
+    with span('generate', provider=client.provider, model=client.model, temperature=temperature) as generate_span:
+        text = ""
+        response = client.stream(system_message, nl_instruction, temperature=temperature, max_tokens=max_tokens)
+        try:
+            async for chunk in response:
+                if not text:
+                    generate_span.set(first_chunk_ms=round((time.perf_counter() - started_at) * 1000, 1))
+                text += chunk
+                if complete_block_pattern.search(text):
+                    break
+        finally:
+            # Closing the stream cancels the rest of the response
+            await response.aclose()
+        generate_span.set(output_chars=len(text))
+        return text
+
+
+async def generate_candidate(client, system_message, nl_instruction, render, temperature=0.5, max_tokens=None, diagram_type=None):
+    """
+    Generates one candidate diagram: LLM completion, extraction, then validation and rendering.
+
+    Args:
+    - client (LLMClient): The client generating the code.
+    - system_message (str): The instruction message.
+    - nl_instruction (str): The user instruction.
+    - render (callable): Blocking function turning PlantUML code into (image bytes, error message).
+    - temperature (float): The sampling temperature of this candidate.
+    - diagram_type (str): The diagram type selected by the user, whose @start tag the code must use.
+
+    Returns:
+    - tuple: (PlantUML code, image bytes, error message).
+    """
+    generated_code = await stream_plantuml(client, system_message, nl_instruction, temperature=temperature, max_tokens=max_tokens)
+    with span('extract'):
+        plantuml_code = extract_plantuml_code(generated_code, diagram_type)
+    if not plantuml_code:
+        return None, None, "No valid PlantUML code block found."
+    # Rendering blocks on the render pool, so keep it off the event loop; the copied context
+    # keeps the render span in the trace of this candidate
+    image_bytes, error_message = await asyncio.get_running_loop().run_in_executor(None, contextvars.copy_context().run, render, plantuml_code)
+    return plantuml_code, image_bytes, error_message
+
+
+async def first_valid_diagram(candidates, system_message, nl_instruction, render, max_tokens=None, diagram_type=None):
+    """
+    Generates several candidates concurrently and returns the first one that renders.
+
+    The remaining candidates are cancelled as soon as one succeeds, which also closes their
+    streaming responses.
+
+    Args:
+    - candidates (list): (LLMClient, temperature) pairs, one per candidate.
+    - system_message (str): The instruction message.
+    - nl_instruction (str): The user instruction.
+    - render (callable): Blocking function turning PlantUML code into (image bytes, error message).
+    - diagram_type (str): The diagram type selected by the user.
+
+    Returns:
+    - tuple: (PlantUML code, image bytes, None) for the winner, or (last code, None, last error message).
+    """
+    tasks = [
+        asyncio.ensure_future(generate_candidate(client, system_message, nl_instruction, render, temperature, max_tokens, diagram_type))
+        for client, temperature in candidates
+    ]
+    last_code, last_error = None, "No candidate was generated."
+    try:
+        for next_candidate in asyncio.as_completed(tasks):
+            try:
+                plantuml_code, image_bytes, error_message = await next_candidate
+            except BudgetExceeded:
+                # The other candidates share the budget, so none of them can do better
+                raise
+            except Exception as e:
+                last_error = f"An error occurred with the LLM API: {e}"
+                continue
+            if image_bytes:
+                return plantuml_code, image_bytes, None
+            last_code = plantuml_code or last_code
+            last_error = error_message
+        return last_code, None, last_error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def best_of_n_candidates(client, n):
+    """
+    Returns n (client, temperature) pairs spreading the temperatures of candidate_temperatures.
+    """
+    return [(client, candidate_temperatures[i % len(candidate_temperatures)]) for i in range(n)]
+
+
+async def generate_diagram(client, system_message, nl_instruction, render, retries=3, max_tokens=None, diagram_type=None):
+    """
+    Generates and renders one diagram, repairing or regenerating it until it renders.
+
+    Each failed render first gets a targeted repair of its failing lines; when that is not
+    possible, the diagram is regenerated with the error pointed out.
+
+    This is the headless version of the retry loop of the Streamlit agents, used by the batch
+    runner. The agents keep their own loop because every step drives the page (spinners, the
+    code streamed as it arrives, an error per attempt) and goes through the response cache,
+    but they follow the same steps: repair first, then regenerate with the error.
+
+    Args:
+    - client (LLMClient): The client generating the code.
+    - system_message (str): The instruction message.
+    - nl_instruction (str): The user instruction.
+    - render (callable): Blocking function turning PlantUML code into (image bytes, error message).
+    - retries (int): Maximum number of LLM calls.
+    - diagram_type (str): The diagram type selected by the user.
+
+    Returns:
+    - tuple: (PlantUML code, image bytes, error message, number of LLM calls).
+    """
+    loop = asyncio.get_running_loop()
+    plantuml_code, error_message = None, None
+    for attempt in range(1, retries + 1):
+        repaired_code = None
+        repair_prompt = build_repair_prompt(plantuml_code, error_message) if plantuml_code and error_message else None
+        if repair_prompt:
+            with span('repair', retry=attempt) as repair_span:
+                patch_text = await client.complete(repair_system_message, repair_prompt, temperature=0, max_tokens=1000)
+                repaired_code = apply_repair_patch(plantuml_code, patch_text)
+                repair_span.set(patched=repaired_code is not None)
+        if repaired_code:
+            plantuml_code = repaired_code
+            image_bytes, error_message = await loop.run_in_executor(None, contextvars.copy_context().run, render, plantuml_code)
+        else:
+            instruction = nl_instruction
+            if error_message:
+                instruction += f"\n\nThe previous PlantUML code failed with this error, do not repeat it:\n{error_message}"
+            code, image_bytes, error_message = await generate_candidate(client, system_message, instruction, render, max_tokens=max_tokens, diagram_type=diagram_type)
+            plantuml_code = code or plantuml_code
+        if image_bytes:
+            return plantuml_code, image_bytes, None, attempt
+    return plantuml_code, None, error_message, retries
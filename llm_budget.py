@@ -0,0 +1,242 @@
+import collections
+import contextlib
+import contextvars
+import math
+import os
+import threading
+import time
+
+from telemetry import current_span
+
+# Limits set by the operator through the environment; 0 disables a limit
+request_token_budget = int(os.environ.get('LLM_REQUEST_TOKEN_BUDGET', 30000))
+session_token_budget = int(os.environ.get('LLM_SESSION_TOKEN_BUDGET', 300000))
+global_tokens_per_minute = int(os.environ.get('LLM_GLOBAL_TOKENS_PER_MINUTE', 400000))
+request_seconds_budget = float(os.environ.get('LLM_REQUEST_SECONDS', 180))
+
+# Cached input tokens are billed at a fraction of the price, so they count for this share of a token
+cached_token_weight = 0.1
+
+# max_tokens of a generation while its diagram type has too little history, and its floor
+default_max_tokens = 4000
+min_max_tokens = 512
+# Headroom over the p95 output size of a diagram type
+max_tokens_headroom = 1.5
+# Outputs kept per diagram type, and outputs needed before max_tokens adapts
+output_history = 100
+min_output_samples = 5
+
+# Rough size of a token of PlantUML code, for sizes the provider did not report
+chars_per_token = 3
+
+_current_request = contextvars.ContextVar('current_request_budget', default=None)
+
+
+class BudgetExceeded(Exception):
+    """
+    Raised before an LLM call that would go over a token or time budget.
+    """
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / chars_per_token)
+
+
+class SessionBudget:
+    """
+    Tokens used by one user session, against the session limit.
+    """
+
+    def __init__(self, token_limit=None):
+        self.token_limit = session_token_budget if token_limit is None else token_limit
+        self.tokens_used = 0
+        self._lock = threading.Lock()
+
+    def charge(self, tokens):
+        with self._lock:
+            self.tokens_used += tokens
+
+    def remaining(self):
+        """
+        Returns the tokens left in the session, or None without a limit.
+        """
+        if not self.token_limit:
+            return None
+        return max(0, self.token_limit - self.tokens_used)
+
+
+class RequestBudget:
+    """
+    Tokens and time used by one request, such as a click on Generate diagram, with every retry.
+    """
+
+    def __init__(self, session=None, token_limit=None, seconds=None):
+        self.session = session
+        self.token_limit = request_token_budget if token_limit is None else token_limit
+        self.seconds = request_seconds_budget if seconds is None else seconds
+        self.started_at = time.monotonic()
+        self.tokens_used = 0
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def charge(self, tokens):
+        with self._lock:
+            self.tokens_used += tokens
+            self.calls += 1
+        if self.session is not None:
+            self.session.charge(tokens)
+
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    def remaining_tokens(self):
+        """
+        Returns the tokens left to the request and its session, or None without a limit.
+        """
+        remaining = [max(0, self.token_limit - self.tokens_used)] if self.token_limit else []
+        if self.session is not None and self.session.remaining() is not None:
+            remaining.append(self.session.remaining())
+        return min(remaining) if remaining else None
+
+
+class BudgetGovernor:
+    """
+    Process-wide gate of the LLM calls.
+
+    Every call is admitted against the budget of its request and session (see request_budget)
+    and the token rate of the whole process, then charged with the usage the provider reports.
+    The governor also learns how long the answers of each diagram type are, so a generation
+    asks for a max_tokens close to what it needs instead of the provider maximum.
+    """
+
+    def __init__(self, tokens_per_minute=None):
+        self.tokens_per_minute = global_tokens_per_minute if tokens_per_minute is None else tokens_per_minute
+        self.rejected = collections.Counter()
+        # (timestamp, tokens) of the calls of the last minute
+        self._window = collections.deque()
+        self._window_tokens = 0
+        self._outputs = {}
+        self._lock = threading.Lock()
+
+    def _trim(self, now):
+        while self._window and now - self._window[0][0] > 60:
+            self._window_tokens -= self._window.popleft()[1]
+
+    def _reject(self, limit, message):
+        with self._lock:
+            self.rejected[limit] += 1
+        current_span().set(budget_exceeded=limit)
+        raise BudgetExceeded(message)
+
+    def tokens_last_minute(self):
+        with self._lock:
+            self._trim(time.monotonic())
+            return self._window_tokens
+
+    def admit(self, max_tokens=None):
+        """
+        Checks the budgets before an LLM call of the current request.
+
+        Args:
+        - max_tokens (int): The max_tokens the call asks for, or None for the provider default.
+
+        Returns:
+        - int: max_tokens, lowered to the tokens the request and session have left.
+
+        Raises:
+        - BudgetExceeded: When the request, its session or the process is over budget.
+        """
+        if self.tokens_per_minute and self.tokens_last_minute() >= self.tokens_per_minute:
+            self._reject('global', "The service has reached its token limit per minute, please try again in a minute.")
+
+        request = _current_request.get()
+        if request is None:
+            return max_tokens
+        if request.seconds and request.elapsed() > request.seconds:
+            self._reject('latency', f"This request has used its time budget of {request.seconds:g} seconds.")
+        remaining = request.remaining_tokens()
+        if remaining is None:
+            return max_tokens
+        if remaining < min_max_tokens:
+            if request.session is not None and request.session.remaining() == remaining:
+                self._reject('session', f"This session has used its budget of {request.session.token_limit} tokens.")
+            self._reject('request', f"This request has used its budget of {request.token_limit} tokens.")
+        if max_tokens is None:
+            # Only cap the provider default when less is left than a full generation
+            return remaining if remaining < default_max_tokens else None
+        return min(max_tokens, remaining)
+
+    def charge(self, usage):
+        """
+        Charges the usage of one call to the current request, its session and the process.
+        """
+        cached = usage.cached_input_tokens
+        tokens = usage.input_tokens - cached + round(cached * cached_token_weight) + usage.output_tokens
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            self._window.append((now, tokens))
+            self._window_tokens += tokens
+        request = _current_request.get()
+        if request is not None:
+            request.charge(tokens)
+
+    def max_tokens(self, diagram_type, retry=False):
+        """
+        Returns the max_tokens of a generation: the p95 output size of the diagram type with headroom.
+
+        A retry gets the full default, in case the previous answer was cut short.
+        """
+        if retry:
+            return default_max_tokens
+        with self._lock:
+            sizes = sorted(self._outputs.get(diagram_type, ()))
+        if len(sizes) < min_output_samples:
+            return default_max_tokens
+        p95 = sizes[min(len(sizes) - 1, int(len(sizes) * 0.95))]
+        return max(min_max_tokens, min(default_max_tokens, int(p95 * max_tokens_headroom)))
+
+    def record_output(self, diagram_type, generated_code):
+        """
+        Records the size of a complete answer, to adapt the max_tokens of the diagram type.
+        """
+        with self._lock:
+            history = self._outputs.setdefault(diagram_type, collections.deque(maxlen=output_history))
+            history.append(estimate_tokens(generated_code))
+
+
+@contextlib.contextmanager
+def request_budget(session=None, token_limit=None, seconds=None):
+    """
+    Runs a block as one request: the LLM calls inside it share a token and time budget.
+
+    Args:
+    - session (SessionBudget): The budget of the user session, if any.
+    - token_limit (int): Tokens of the request, by default request_token_budget; 0 for no limit.
+    - seconds (float): Time of the request, by default request_seconds_budget; 0 for no limit.
+
+    Returns:
+    - RequestBudget: The running budget, with tokens_used and calls.
+    """
+    budget = RequestBudget(session, token_limit, seconds)
+    token = _current_request.set(budget)
+    try:
+        yield budget
+    finally:
+        _current_request.reset(token)
+
+
+# Budget governor shared by every Streamlit session of this process
+_governor = None
+_governor_lock = threading.Lock()
+
+
+def get_budget_governor():
+    """
+    Returns the process-wide budget governor, creating it on first use.
+    """
+    global _governor
+    with _governor_lock:
+        if _governor is None:
+            _governor = BudgetGovernor()
+        return _governor
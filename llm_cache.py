@@ -0,0 +1,133 @@
+import collections
+import hashlib
+import os
+import re
+import threading
+import time
+
+
+# Shingle overlap from which a different instruction reuses a cached response; unset for exact matches only
+similarity_threshold = float(os.environ['LLM_CACHE_SIMILARITY']) if os.environ.get('LLM_CACHE_SIMILARITY') else None
+
+
+def normalize_instruction(nl_instruction):
+    """
+    Normalizes a natural language instruction so that trivially different prompts share a cache entry.
+
+    Args:
+    - nl_instruction (str): The instruction typed by the user.
+
+    Returns:
+    - str: The lower-cased instruction with collapsed whitespace and no trailing punctuation.
+    """
+    return re.sub(r"\s+", " ", nl_instruction).strip().lower().rstrip(".!?")
+
+
+def shingles(text, size=4):
+    text = f" {text} "
+    return {text[i:i + size] for i in range(max(1, len(text) - size + 1))}
+
+
+class ResponseCache:
+    """
+    In-memory cache of LLM responses with TTL and LRU eviction.
+
+    Entries are scoped by model, system message and diagram type, so a cached diagram is only
+    reused when every sidebar option matched. The system message may be given as the
+    prompt_hash of a compiled prompt (see prompts.compile_instruction_prompt), which avoids
+    hashing the whole text on every lookup. Inside a scope, an exact match on the normalized
+    instruction is tried first; with similarity_threshold set, the closest instruction by
+    character shingle overlap is accepted as well.
+    """
+
+    def __init__(self, max_entries=512, ttl=3600, similarity_threshold=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.hits = 0
+        self.misses = 0
+        # key -> (created_at, scope, instruction shingles, response)
+        self._entries = collections.OrderedDict()
+        # scope -> keys of the entries in that scope, for similarity lookups
+        self._scopes = collections.defaultdict(set)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _scope(system_message, diagram_type, model):
+        return hashlib.sha256(f"{model}\0{diagram_type}\0{system_message}".encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _key(scope, instruction):
+        return hashlib.sha256(f"{scope}\0{instruction}".encode('utf-8')).hexdigest()
+
+    def _remove(self, key):
+        _, scope, _, _ = self._entries.pop(key)
+        self._scopes[scope].discard(key)
+        if not self._scopes[scope]:
+            del self._scopes[scope]
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > self.ttl:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[3]
+
+    def get(self, system_message, diagram_type, nl_instruction, model=''):
+        scope = self._scope(system_message, diagram_type, model)
+        instruction = normalize_instruction(nl_instruction)
+        with self._lock:
+            response = self._lookup(self._key(scope, instruction))
+            if response is None and self.similarity_threshold:
+                wanted = shingles(instruction)
+                best_key, best_score = None, 0.0
+                for key in list(self._scopes.get(scope, ())):
+                    candidate = self._entries[key][2]
+                    score = len(wanted & candidate) / len(wanted | candidate)
+                    if score > best_score:
+                        best_key, best_score = key, score
+                if best_key and best_score >= self.similarity_threshold:
+                    response = self._lookup(best_key)
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return response
+
+    def put(self, system_message, diagram_type, nl_instruction, response, model=''):
+        scope = self._scope(system_message, diagram_type, model)
+        instruction = normalize_instruction(nl_instruction)
+        key = self._key(scope, instruction)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic(), scope, shingles(instruction), response)
+            self._scopes[scope].add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def discard(self, system_message, diagram_type, nl_instruction, model=''):
+        scope = self._scope(system_message, diagram_type, model)
+        key = self._key(scope, normalize_instruction(nl_instruction))
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+
+# Response cache shared by every Streamlit session of this process
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """
+    Returns the process-wide response cache, creating it on first use.
+    """
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache(similarity_threshold=similarity_threshold)
+        return _response_cache
@@ -0,0 +1,362 @@
+import asyncio
+import atexit
+import collections
+import contextvars
+import math
+import threading
+
+from llm_budget import chars_per_token, default_max_tokens, estimate_tokens, get_budget_governor
+from telemetry import current_span
+
+# Connection pool shared by every request of a client; keep-alive avoids a TLS handshake per call
+max_connections = 100
+max_keepalive_connections = 20
+keepalive_expiry = 30
+
+# Mark the system message as a cacheable prefix on providers that need it marked (Anthropic);
+# OpenAI caches long prefixes on its own. Prefixes below the provider minimum are never cached.
+cache_system_prompt = True
+
+# Token counts of one call, as reported by the provider. input_tokens counts every input
+# token, including cached_input_tokens read from the prompt cache and cache_write_tokens
+# written to it.
+Usage = collections.namedtuple('Usage', ['input_tokens', 'cached_input_tokens', 'cache_write_tokens', 'output_tokens'])
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _get_loop():
+    # One event loop per process, running in a daemon thread, so the pooled connections
+    # of the clients outlive Streamlit reruns and can be used from any script thread
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='llm-client-loop', daemon=True).start()
+        return _loop
+
+
+async def _in_context(coro, context):
+    # Context variables of the calling thread, such as the current telemetry span, are not
+    # inherited by tasks of the loop thread, so copy them into the task first
+    for variable, value in context.items():
+        variable.set(value)
+    return await coro
+
+
+def submit(coro):
+    """
+    Schedules a coroutine on the client event loop, with the context variables of the caller.
+
+    Returns:
+    - concurrent.futures.Future: Cancelling it cancels the request, closing its connection.
+    """
+    return asyncio.run_coroutine_threadsafe(_in_context(coro, contextvars.copy_context()), _get_loop())
+
+
+def run_sync(coro, timeout=None):
+    """
+    Runs a coroutine on the client event loop and waits for its result from a regular thread.
+    """
+    future = submit(coro)
+    try:
+        return future.result(timeout)
+    except BaseException:
+        future.cancel()
+        raise
+
+
+async def _next(async_iterator):
+    return await async_iterator.__anext__()
+
+
+async def _close(async_iterator):
+    await async_iterator.aclose()
+
+
+def iterate_sync(async_iterator, timeout=None):
+    """
+    Iterates an async generator, such as LLMClient.stream, from a regular thread.
+
+    Closing the returned generator early closes the async one too, which cancels the response.
+    """
+    try:
+        while True:
+            try:
+                yield run_sync(_next(async_iterator), timeout)
+            except StopAsyncIteration:
+                return
+    finally:
+        run_sync(_close(async_iterator))
+
+
+class LLMClient:
+    """
+    Provider-agnostic async chat client: one system message, one user message, text out.
+
+    Subclasses wrap the async SDK of a provider with a pooled keep-alive HTTP client. base_url
+    points a client at another endpoint, such as a local stub server in tests.
+    """
+
+    provider = None
+
+    def __init__(self, api_key, model, base_url=None, timeout=60):
+        self.api_key = api_key
+        self.model = model
+        self.base_url = base_url
+        self.timeout = timeout
+        self._client = None
+
+    def _http_client(self):
+        import httpx
+
+        return httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+        )
+
+    async def complete(self, system_message, user_message, temperature=0.5, max_tokens=None):
+        """
+        Returns the full text of a completion.
+        """
+        text = ""
+        async for chunk in self.stream(system_message, user_message, temperature=temperature, max_tokens=max_tokens):
+            text += chunk
+        return text
+
+    def stream(self, system_message, user_message, temperature=0.5, max_tokens=None):
+        """
+        Returns an async generator of the completion text as it is generated.
+        Closing the generator cancels the response.
+        """
+        raise NotImplementedError
+
+    def _admit(self, max_tokens):
+        # Raises BudgetExceeded when the request, its session or the process is over budget
+        return get_budget_governor().admit(max_tokens)
+
+    def _record_usage(self, usage, estimated=()):
+        # Added to the span of the calling stage, e.g. 'generate' or 'repair', and charged to the budgets.
+        # Fields the provider did not report go to estimated_* attributes, out of the reported counts
+        current_span().add(**{
+            f"estimated_{field}" if field in estimated else field: count
+            for field, count in usage._asdict().items() if count or field not in estimated
+        })
+        if estimated:
+            current_span().set(usage_estimated=True)
+        get_budget_governor().charge(usage)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+
+class OpenAIClient(LLMClient):
+    provider = 'openai'
+
+    @staticmethod
+    def _usage(usage):
+        details = getattr(usage, 'prompt_tokens_details', None)
+        return Usage(
+            input_tokens=usage.prompt_tokens,
+            cached_input_tokens=(getattr(details, 'cached_tokens', None) or 0) if details else 0,
+            cache_write_tokens=0,
+            output_tokens=usage.completion_tokens,
+        )
+
+    def _get_client(self):
+        if self._client is None:
+            from openai import AsyncOpenAI
+
+            self._client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, http_client=self._http_client())
+        return self._client
+
+    async def complete(self, system_message, user_message, temperature=0.5, max_tokens=None):
+        max_tokens = self._admit(max_tokens)
+        response = await self._get_client().chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": system_message},
+                {"role": "user", "content": user_message}
+            ],
+            temperature=temperature,
+            stream=False,
+            **({'max_tokens': max_tokens} if max_tokens else {}),
+        )
+        if response.usage:
+            self._record_usage(self._usage(response.usage))
+        return response.choices[0].message.content
+
+    async def stream(self, system_message, user_message, temperature=0.5, max_tokens=None):
+        max_tokens = self._admit(max_tokens)
+        response = await self._get_client().chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": system_message},
+                {"role": "user", "content": user_message}
+            ],
+            temperature=temperature,
+            stream=True,
+            # The usage comes in a last chunk without choices, so a stream closed early reports none
+            stream_options={"include_usage": True},
+            **({'max_tokens': max_tokens} if max_tokens else {}),
+        )
+        output_chars = 0
+        usage = None
+        try:
+            async for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    output_chars += len(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+                if getattr(chunk, 'usage', None):
+                    usage = self._usage(chunk.usage)
+        finally:
+            await response.close()
+            if usage is not None:
+                self._record_usage(usage)
+            else:
+                # Closed before the usage chunk: nothing was reported, so estimate it for the budgets
+                usage = Usage(estimate_tokens(system_message + user_message), 0, 0, math.ceil(output_chars / chars_per_token))
+                self._record_usage(usage, estimated=Usage._fields)
+
+
+class AnthropicClient(LLMClient):
+    provider = 'anthropic'
+
+    def _get_client(self):
+        if self._client is None:
+            from anthropic import AsyncAnthropic
+
+            self._client = AsyncAnthropic(api_key=self.api_key, base_url=self.base_url, http_client=self._http_client())
+        return self._client
+
+    @staticmethod
+    def _system(system_message):
+        # The system message is the static part of every request (role, option rules and the
+        # example of the diagram type), so it is the prefix marked for the prompt cache
+        if not cache_system_prompt:
+            return system_message
+        return [
+            {
+                "type": "text",
+                "text": system_message,
+                "cache_control": {"type": "ephemeral"}
+            }
+        ]
+
+    @staticmethod
+    def _usage(usage, output_tokens=None):
+        cached_input_tokens = getattr(usage, 'cache_read_input_tokens', None) or 0
+        cache_write_tokens = getattr(usage, 'cache_creation_input_tokens', None) or 0
+        return Usage(
+            input_tokens=usage.input_tokens + cached_input_tokens + cache_write_tokens,
+            cached_input_tokens=cached_input_tokens,
+            cache_write_tokens=cache_write_tokens,
+            output_tokens=usage.output_tokens if output_tokens is None else output_tokens,
+        )
+
+    @staticmethod
+    def _messages(user_message):
+        return [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": user_message
+                    }
+                ]
+            }
+        ]
+
+    async def complete(self, system_message, user_message, temperature=0.5, max_tokens=None):
+        response = await self._get_client().messages.create(
+            model=self.model,
+            max_tokens=self._admit(max_tokens or default_max_tokens),
+            temperature=temperature,
+            system=self._system(system_message),
+            messages=self._messages(user_message),
+        )
+        self._record_usage(self._usage(response.usage))
+        return response.content[0].text
+
+    async def stream(self, system_message, user_message, temperature=0.5, max_tokens=None):
+        async with self._get_client().messages.stream(
+            model=self.model,
+            max_tokens=self._admit(max_tokens or default_max_tokens),
+            temperature=temperature,
+            system=self._system(system_message),
+            messages=self._messages(user_message),
+        ) as response:
+            # The input usage arrives with the first event and the output count with the last
+            # one; a stream closed early records its input tokens and an estimate of its output
+            input_usage = None
+            output_chars = 0
+            output_tokens = None
+            try:
+                async for event in response:
+                    if event.type == 'message_start':
+                        input_usage = event.message.usage
+                    elif event.type == 'message_delta' and event.usage:
+                        output_tokens = event.usage.output_tokens
+                    elif event.type == 'content_block_delta' and event.delta.type == 'text_delta':
+                        output_chars += len(event.delta.text)
+                        yield event.delta.text
+            finally:
+                estimated = ()
+                if output_tokens is None:
+                    output_tokens = math.ceil(output_chars / chars_per_token)
+                    estimated = ('output_tokens',)
+                if input_usage is not None:
+                    self._record_usage(self._usage(input_usage, output_tokens), estimated=estimated)
+
+
+client_classes = {
+    'openai': OpenAIClient,
+    'anthropic': AnthropicClient,
+}
+
+# Clients shared by every Streamlit session of this process
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(provider, api_key, model, base_url=None):
+    """
+    Returns the process-wide client for a provider and model, creating it on first use.
+
+    Args:
+    - provider (str): 'openai' or 'anthropic'.
+    - api_key (str): The API key of the provider.
+    - model (str): The model used for every request of the client.
+    - base_url (str): Optional endpoint overriding the provider default.
+
+    Returns:
+    - LLMClient: The shared client.
+    """
+    key = (provider, api_key, model, base_url)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = client_classes[provider](api_key, model, base_url=base_url)
+            _clients[key] = client
+        return client
+
+
+@atexit.register
+def _close_clients():
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    if _loop is not None and _loop.is_running():
+        for client in clients:
+            try:
+                run_sync(client.aclose(), timeout=5)
+            except Exception:
+                pass
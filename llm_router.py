@@ -0,0 +1,199 @@
+import asyncio
+import collections
+import threading
+import time
+
+from llm_budget import BudgetExceeded
+from llm_client import LLMClient
+from telemetry import current_span
+
+
+class ProviderStats:
+    """
+    Rolling latency and error rate of one provider, over its last `window` requests.
+
+    Latencies are kept per kind of request: time to first token for streams and total time for
+    complete calls, since the two are not comparable. Outcomes older than `error_horizon` seconds
+    are forgotten, so a provider that failed gets tried again later.
+    """
+
+    def __init__(self, window=50, error_horizon=300, max_consecutive_failures=3, cooldown=30):
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.outcomes = collections.deque(maxlen=window)
+        self.error_horizon = error_horizon
+        self.max_consecutive_failures = max_consecutive_failures
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+
+    def record_success(self, kind, latency):
+        self.latencies[kind].append(latency)
+        self.outcomes.append((time.monotonic(), True))
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        self.outcomes.append((time.monotonic(), False))
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.max_consecutive_failures:
+            # Rate limited or down: stop sending it traffic for a while
+            self.cooldown_until = time.monotonic() + self.cooldown
+
+    def error_rate(self):
+        horizon = time.monotonic() - self.error_horizon
+        recent = [ok for recorded_at, ok in self.outcomes if recorded_at >= horizon]
+        return recent.count(False) / len(recent) if recent else 0.0
+
+    def healthy(self):
+        return time.monotonic() >= self.cooldown_until and self.error_rate() < 0.5
+
+    def expected_latency(self, kind):
+        latencies = self.latencies[kind]
+        # Providers without history are tried first, so that every provider gets measured
+        return sum(latencies) / len(latencies) if latencies else 0.0
+
+    def p95(self, kind, min_samples=5):
+        latencies = sorted(self.latencies[kind])
+        if len(latencies) < min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+
+class ProviderRouter(LLMClient):
+    """
+    Routes every request to the fastest healthy provider, with failover and optional hedging.
+
+    The router has the LLMClient interface, so it can be used wherever a single client is.
+    A failed request moves on to the next provider. With hedging on, a second provider is
+    started once the first one is slower than its own p95 latency, and the first answer wins.
+    """
+
+    provider = 'router'
+
+    def __init__(self, clients, hedge=True):
+        self.clients = list(clients)
+        self.hedge = hedge
+        self.model = "+".join(f"{client.provider}:{client.model}" for client in self.clients)
+        self.stats = {id(client): ProviderStats() for client in self.clients}
+
+    def ranked(self, kind):
+        """
+        Returns the clients from the most to the least preferred: healthy ones first, then by latency.
+        """
+        return sorted(
+            self.clients,
+            key=lambda client: (not self.stats[id(client)].healthy(), self.stats[id(client)].expected_latency(kind))
+        )
+
+    async def _timed(self, client, kind, request):
+        started_at = time.monotonic()
+        try:
+            result = await request
+        except (asyncio.CancelledError, BudgetExceeded):
+            # An exhausted budget says nothing about the health of the provider
+            raise
+        except Exception:
+            self.stats[id(client)].record_failure()
+            raise
+        self.stats[id(client)].record_success(kind, time.monotonic() - started_at)
+        return result
+
+    async def _race(self, kind, make_request, discard=None):
+        # Runs make_request(client) on the preferred client, failing over and hedging as needed.
+        # discard(result) releases results of losing attempts that still completed.
+        candidates = iter(self.ranked(kind))
+        attempts = {}
+        last_error = None
+
+        def start_next():
+            client = next(candidates, None)
+            if client is None:
+                return False
+            task = asyncio.ensure_future(self._timed(client, kind, make_request(client)))
+            attempts[task] = client
+            return True
+
+        start_next()
+        hedged = False
+        try:
+            while attempts:
+                timeout = None
+                if self.hedge and not hedged and len(attempts) == 1:
+                    timeout = self.stats[id(next(iter(attempts.values())))].p95(kind)
+                done, _ = await asyncio.wait(attempts, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Slower than its own p95: hedge on the next provider
+                    start_next()
+                    hedged = True
+                    continue
+                for task in done:
+                    client = attempts.pop(task)
+                    if task.exception() is None:
+                        # On the span of the calling stage: the router is shared by every session
+                        current_span().set(served_by=client.provider)
+                        result = task.result()
+                        for other in done:
+                            if other is not task and other in attempts and other.exception() is None and discard:
+                                await discard(other.result())
+                        return result
+                    last_error = task.exception()
+                    if isinstance(last_error, BudgetExceeded):
+                        # Every other provider would be refused as well
+                        raise last_error
+                if not attempts:
+                    start_next()
+            raise last_error or RuntimeError("No provider is configured.")
+        finally:
+            for task in attempts:
+                task.cancel()
+
+    async def complete(self, system_message, user_message, temperature=0.5, max_tokens=None):
+        return await self._race(
+            'complete',
+            lambda client: client.complete(system_message, user_message, temperature=temperature, max_tokens=max_tokens)
+        )
+
+    async def stream(self, system_message, user_message, temperature=0.5, max_tokens=None):
+        async def open_stream(client):
+            # A stream counts as answered once its first chunk arrived
+            response = client.stream(system_message, user_message, temperature=temperature, max_tokens=max_tokens)
+            try:
+                first_chunk = await response.__anext__()
+            except StopAsyncIteration:
+                first_chunk = ""
+            except BaseException:
+                await response.aclose()
+                raise
+            return response, first_chunk
+
+        async def discard(opened):
+            await opened[0].aclose()
+
+        response, first_chunk = await self._race('stream', open_stream, discard=discard)
+        try:
+            yield first_chunk
+            async for chunk in response:
+                yield chunk
+        finally:
+            await response.aclose()
+
+    async def aclose(self):
+        for client in self.clients:
+            await client.aclose()
+
+
+# Routers shared by every Streamlit session of this process, so their statistics survive reruns
+_routers = {}
+_routers_lock = threading.Lock()
+
+
+def get_router(clients):
+    """
+    Returns the process-wide router for a list of clients, creating it on first use.
+    """
+    key = tuple(id(client) for client in clients)
+    with _routers_lock:
+        router = _routers.get(key)
+        if router is None:
+            router = ProviderRouter(clients)
+            _routers[key] = router
+        return router
@@ -0,0 +1,278 @@
+import collections
+import functools
+import os
+import queue
+import re
+import subprocess
+import threading
+import time
+import uuid
+import zipfile
+
+# Largest width or height in pixels of a raster image; PlantUML crops larger diagrams at 4096
+plantuml_limit_size = int(os.environ.get('PLANTUML_LIMIT_SIZE', 8192))
+
+# Small diagram used to check that a warm renderer still answers
+health_check_diagram = "@startuml\nA -> B\n@enduml"
+
+# PlantUML is deterministic: these failures come back identical on every render of the same source
+syntax_error_pattern = re.compile(r"^Error line \S+:|has no @end tag", re.MULTILINE)
+# Failures that no retry can fix until the deployment itself is repaired
+environment_error_pattern = re.compile(
+    r"Unable to access jarfile|Invalid or corrupt jarfile|No such file or directory: 'java'|Could not find or load main class",
+    re.IGNORECASE
+)
+# A render that ran out of time on a JVM; a retry would most likely take as long again
+render_timeout_pattern = re.compile(r"^PlantUML render timed out")
+busy_retry_pattern = re.compile(r"busy, retry in (\d+) s")
+
+
+class PlantUMLRenderer:
+    """
+    Keeps one PlantUML JVM warm in `-pipe` mode and renders diagrams through its stdin/stdout.
+
+    Every diagram written to stdin is answered on stdout with the image bytes followed by a
+    unique delimiter, so the JVM start-up and class loading are paid once per process instead
+    of once per render. A dead or stuck JVM is killed and restarted on the next request.
+    """
+
+    def __init__(self, plantuml_jar_path, output_format='png', timeout=60, max_renders=500, java_options=None):
+        self.plantuml_jar_path = str(plantuml_jar_path)
+        self.output_format = output_format
+        self.timeout = timeout
+        self.max_renders = max_renders
+        self.java_options = list(java_options or [])
+        self.restarts = 0
+        self._delimiter = f"--plantuml-render-{uuid.uuid4().hex}--".encode()
+        self._process = None
+        self._chunks = None
+        self._pending = b""
+        self._renders = 0
+        self._stderr_tail = collections.deque(maxlen=50)
+        self._stderr_thread = None
+        self._lock = threading.Lock()
+
+    def _command(self):
+        return [
+            'java', '-Djava.awt.headless=true', f'-DPLANTUML_LIMIT_SIZE={plantuml_limit_size}', *self.java_options,
+            '-jar', self.plantuml_jar_path,
+            '-charset', 'UTF-8',
+            '-pipe', '-pipeNoStderr',
+            '-pipedelimitor', self._delimiter.decode(),
+            f'-t{self.output_format}',
+        ]
+
+    @staticmethod
+    def _pump(stream, sink):
+        # Forward raw stdout chunks to the render thread; None marks the end of the stream
+        while True:
+            chunk = stream.read1(65536)
+            if not chunk:
+                sink.put(None)
+                return
+            sink.put(chunk)
+
+    @staticmethod
+    def _pump_stderr(stream, tail):
+        for line in iter(stream.readline, b""):
+            tail.append(line.decode(errors='replace').rstrip())
+
+    def _start(self):
+        self._process = subprocess.Popen(
+            self._command(),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        self._chunks = queue.Queue()
+        self._pending = b""
+        self._renders = 0
+        self._stderr_tail.clear()
+        threading.Thread(target=self._pump, args=(self._process.stdout, self._chunks), daemon=True).start()
+        self._stderr_thread = threading.Thread(target=self._pump_stderr, args=(self._process.stderr, self._stderr_tail), daemon=True)
+        self._stderr_thread.start()
+
+    def _stop(self, kill=False):
+        # Returns the exit code of the stopped process, if there was one. A killed process gets
+        # no chance to exit on its own, for a JVM stuck in a render
+        process, self._process = self._process, None
+        if process is None:
+            return None
+        if kill:
+            process.kill()
+        else:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+        try:
+            process.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        return process.returncode
+
+    def _ensure_started(self):
+        if self._process is not None and (self._process.poll() is not None or self._renders >= self.max_renders):
+            self._stop()
+            self.restarts += 1
+        if self._process is None:
+            self._start()
+
+    def _read_until_delimiter(self, deadline):
+        buffer = self._pending.lstrip(b"\r\n")
+        while True:
+            index = buffer.find(self._delimiter)
+            if index != -1:
+                self._pending = buffer[index + len(self._delimiter):]
+                return buffer[:index]
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError
+            try:
+                chunk = self._chunks.get(timeout=remaining)
+            except queue.Empty:
+                raise TimeoutError
+            if chunk is None:
+                raise BrokenPipeError("PlantUML process exited")
+            buffer += chunk
+
+    def _render_once(self, plantuml_code, timeout):
+        deadline = time.monotonic() + timeout
+        self._process.stdin.write(plantuml_code.rstrip().encode('utf-8') + b"\n")
+        self._process.stdin.flush()
+        payload = self._read_until_delimiter(deadline)
+        self._renders += 1
+
+        # With -pipeNoStderr, PlantUML answers a broken diagram with "ERROR", the line and the description
+        if payload.startswith(b"ERROR"):
+            lines = payload.decode('utf-8', errors='replace').splitlines()[1:]
+            line_number = lines[0].strip() if lines else "?"
+            description = "\n".join(lines[1:]).strip() or "Syntax Error?"
+            return None, f"Error line {line_number}: {description}"
+        if not payload:
+            return None, "Failed to create the output diagram or PlantUML error."
+        return payload, None
+
+    def render(self, plantuml_code, timeout=None):
+        """
+        Renders a single @startXXX ... @endXXX block with the warm PlantUML process.
+
+        Args:
+        - plantuml_code (str): The PlantUML source to render.
+        - timeout (float): Seconds allowed for this render, by default the renderer timeout.
+          A render that runs over is stopped by restarting the JVM.
+
+        Returns:
+        - tuple: (image bytes, None) on success or (None, error message) on failure.
+        """
+        if "@end" not in plantuml_code:
+            # The pipe only answers once it has read a closing @endXXX line
+            return None, "PlantUML code has no @end tag."
+
+        timeout = timeout or self.timeout
+        with self._lock:
+            error_message = None
+            for _ in range(2):
+                try:
+                    self._ensure_started()
+                    return self._render_once(plantuml_code, timeout)
+                except TimeoutError:
+                    self._stop(kill=True)
+                    self.restarts += 1
+                    return None, f"PlantUML render timed out after {timeout} s"
+                except (OSError, ValueError) as e:
+                    # Broken pipe or a JVM that died mid-render: restart once and try again
+                    exit_code = self._stop()
+                    if self._stderr_thread is not None:
+                        self._stderr_thread.join(timeout=1)
+                    details = "\n".join(self._stderr_tail)
+                    error_message = f"An error occurred: {e}"
+                    if exit_code is not None:
+                        error_message += f" (exit code {exit_code})"
+                    if details:
+                        error_message += f"\n{details}"
+                    self.restarts += 1
+            return None, error_message
+
+    def is_alive(self):
+        return self._process is not None and self._process.poll() is None
+
+    @property
+    def pid(self):
+        # Process id of the warm JVM, or None when it is not running
+        return self._process.pid if self.is_alive() else None
+
+    def health_check(self, timeout=10):
+        """
+        Renders a tiny diagram to make sure the warm JVM still answers, restarting it if needed.
+        """
+        image_bytes, _ = self.render(health_check_diagram, timeout=timeout)
+        return image_bytes is not None
+
+    def close(self):
+        with self._lock:
+            self._stop()
+
+
+def classify_render_error(error_message):
+    """
+    Tells apart render failures that are worth retrying from those that are not.
+
+    Args:
+    - error_message (str): The error returned by a render.
+
+    Returns:
+    - str: 'syntax' when the source itself is broken and PlantUML will fail the same way again,
+      'environment' when Java or the jar is missing, 'timeout' when the render itself ran out of
+      time, or 'transient' for a busy pool, time spent in the queue, memory exhaustion and
+      crashed processes.
+    """
+    if syntax_error_pattern.search(error_message):
+        return 'syntax'
+    if environment_error_pattern.search(error_message):
+        return 'environment'
+    if render_timeout_pattern.search(error_message):
+        return 'timeout'
+    return 'transient'
+
+
+def retry_delay(error_message, attempt, base_delay=0.5):
+    """
+    Returns the seconds to wait before retrying a transient failure: the delay asked for by a
+    busy scheduler, or an exponential backoff.
+    """
+    match = busy_retry_pattern.search(error_message)
+    if match:
+        return float(match.group(1))
+    return base_delay * 2 ** attempt
+
+
+def renderer_version(plantuml_jar_path):
+    """
+    Returns the PlantUML version of a jar, read from its manifest without starting a JVM.
+
+    The result is cached per size and modification time of the jar, so replacing the jar
+    changes the version seen by the render cache. Jars without a version in their manifest
+    fall back to their size and modification time.
+    """
+    plantuml_jar_path = str(plantuml_jar_path)
+    try:
+        stat = os.stat(plantuml_jar_path)
+    except OSError:
+        return "unknown"
+    return _jar_version(plantuml_jar_path, stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=None)
+def _jar_version(plantuml_jar_path, mtime_ns, size):
+    try:
+        with zipfile.ZipFile(plantuml_jar_path) as jar:
+            manifest = jar.read('META-INF/MANIFEST.MF').decode('utf-8', errors='replace')
+        for line in manifest.splitlines():
+            if line.startswith('Implementation-Version:'):
+                return line.split(':', 1)[1].strip()
+    except (OSError, KeyError, zipfile.BadZipFile):
+        pass
+    return f"{size}-{mtime_ns}"
+
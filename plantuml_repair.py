@@ -0,0 +1,81 @@
+import re
+
+repair_system_message = '''You are a professional PlantUML coder fixing a syntax error.
+You get the failing lines of a PlantUML diagram, numbered, and the PlantUML error.
+Reply ONLY with the smallest patch that fixes the error, using this format for every changed range:
+REPLACE LINES <first>-<last>
+<new lines>
+END REPLACE
+The new lines replace the numbered lines <first> to <last> included. Explain nothing.'''
+
+error_line_pattern = re.compile(r"Error line (\d+)")
+patch_pattern = re.compile(r"REPLACE LINES (\d+)\s*-\s*(\d+)[^\n]*\n(.*?)^END REPLACE", re.DOTALL | re.MULTILINE)
+
+
+def error_line_numbers(error_details):
+    """
+    Returns the line numbers reported as "Error line N" by PlantUML or the validator.
+    """
+    return sorted({int(number) for number in error_line_pattern.findall(error_details or "")})
+
+
+def build_repair_prompt(failed_code, error_details, context=3):
+    """
+    Builds the user message of a targeted repair: only the lines around the error, numbered, plus the error.
+
+    Args:
+    - failed_code (str): The PlantUML code that failed to render.
+    - error_details (str): The error reported by PlantUML or the validator.
+    - context (int): Number of lines shown on each side of an error line.
+
+    Returns:
+    - str: The repair prompt, or None when the error has no usable line number.
+    """
+    lines = failed_code.splitlines()
+    numbers = [number for number in error_line_numbers(error_details) if 1 <= number <= len(lines)]
+    if not numbers:
+        return None
+
+    shown = set()
+    for number in numbers:
+        shown.update(range(max(1, number - context), min(len(lines), number + context) + 1))
+    excerpt = []
+    previous = None
+    for number in sorted(shown):
+        if previous is not None and number != previous + 1:
+            excerpt.append("...")
+        excerpt.append(f"{number}: {lines[number - 1]}")
+        previous = number
+    excerpt = "\n".join(excerpt)
+
+    return f"PlantUML error:\n{error_details.strip()}\n\nFailing lines:\n{excerpt}"
+
+
+def apply_repair_patch(failed_code, patch_text):
+    """
+    Applies a REPLACE LINES patch returned by the model to the failing code.
+
+    Returns:
+    - str: The patched code, or None when the patch is missing or does not fit the code.
+    """
+    lines = failed_code.splitlines()
+    hunks = []
+    for match in patch_pattern.finditer(patch_text or ""):
+        first, last = int(match.group(1)), int(match.group(2))
+        if not 1 <= first <= last <= len(lines):
+            return None
+        replacement = match.group(3).strip("\n")
+        # Models sometimes echo the line numbers they were shown
+        replacement = [re.sub(r"^\d+: ", "", line) for line in replacement.splitlines()]
+        hunks.append((first, last, replacement))
+    if not hunks:
+        return None
+
+    hunks.sort()
+    for (_, last, _), (first, _, _) in zip(hunks, hunks[1:]):
+        if first <= last:
+            return None
+    # Apply from the bottom so the line numbers of earlier hunks stay valid
+    for first, last, replacement in reversed(hunks):
+        lines[first - 1:last] = replacement
+    return "\n".join(lines)
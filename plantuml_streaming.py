@@ -0,0 +1,69 @@
+import re
+import time
+
+from data import any_diagram_type, resolve_diagram_type
+
+# A complete @startXXX ... @endXXX block. The lookahead makes sure the closing tag has fully
+# arrived, so that "@endu" is not mistaken for the end of "@enduml".
+complete_block_pattern = re.compile(r"@start\w+.*?@end\w+(?=\W)", re.DOTALL)
+
+
+def extract_plantuml_code(full_code, diagram_type=None):
+    """
+    Extracts the PlantUML code between @startXXX and @endXXX tags.
+    
+    Args:
+    - full_code (str): The full PlantUML code including unwanted text.
+    - diagram_type (str): Optional diagram type; a block with its own tag is preferred over other blocks.
+    
+    Returns:
+    - str: The extracted PlantUML code or None if no valid code block is found.
+    """
+    # A block of the diagram type first, then any block whose @end tag matches its @start tag
+    patterns = [resolve_diagram_type(any_diagram_type).extraction_pattern]
+    record = resolve_diagram_type(diagram_type) if diagram_type else None
+    if record is not None and record.start_tag:
+        patterns.insert(0, record.extraction_pattern)
+    for pattern in patterns:
+        match = pattern.search(full_code)
+        if match:
+            return match.group(0)
+
+    # Regular expression to find blocks starting with @start and ending with @end
+    pattern = re.compile(r"@start\w+.*?@end\w+", re.DOTALL)
+    match = pattern.search(full_code)
+    
+    if match:
+        return match.group(0)  # Return the matched block, including start and end tags
+    else:
+        return None  # Return None if no valid block is found
+
+
+def collect_until_plantuml_end(text_chunks, on_partial=None, update_interval=0.1):
+    """
+    Consumes streamed LLM text until the first complete PlantUML block has arrived.
+
+    Args:
+    - text_chunks (iterable): Pieces of generated text, in order.
+    - on_partial (callable): Optional callback receiving the text so far, for live display.
+    - update_interval (float): Minimum seconds between two on_partial calls.
+
+    Returns:
+    - tuple: (text received so far, True if reading stopped at the @end tag before the stream ended).
+    """
+    text = ""
+    last_update = 0.0
+    for chunk in text_chunks:
+        if not chunk:
+            continue
+        text += chunk
+        if complete_block_pattern.search(text):
+            if on_partial:
+                on_partial(text)
+            return text, True
+        if on_partial and time.monotonic() - last_update >= update_interval:
+            on_partial(text)
+            last_update = time.monotonic()
+    if on_partial:
+        on_partial(text)
+    return text, False
@@ -0,0 +1,204 @@
+import collections
+import re
+
+from data import catalog, resolve_diagram_type
+
+# A single finding of the validator; line numbers start at 1
+Diagnostic = collections.namedtuple('Diagnostic', ['line', 'severity', 'message'])
+
+# Start tags understood by PlantUML, on top of the ones used by the diagram catalog
+plantuml_start_tags = {
+    'uml', 'gantt', 'mindmap', 'wbs', 'salt', 'json', 'yaml', 'ebnf', 'nwdiag', 'math', 'latex',
+    'regex', 'chen', 'chronology', 'board', 'files', 'wire', 'creole', 'ditaa', 'dot', 'def',
+    'jcckit', 'flow', 'git', 'project', 'archimate',
+}
+
+# Diagrams whose body is data, where a line starting with ' is content rather than a comment
+uncommented_tags = {'json', 'yaml'}
+
+start_tag_pattern = re.compile(r"^\s*@start(\w+)", re.IGNORECASE)
+end_tag_pattern = re.compile(r"^\s*@end(\w+)", re.IGNORECASE)
+
+# A bare "end", which closes a sequence group but also ends an activity diagram
+bare_end_pattern = re.compile(r"^end\s*$", re.IGNORECASE)
+
+# Nested blocks of @startuml diagrams: (name, opening line, closing line)
+block_rules = [
+    ('group', re.compile(r"^(alt|opt|loop|par|critical|group)\b", re.IGNORECASE),
+     re.compile(r"^end(\s+(alt|opt|loop|par|critical|group))?\s*$", re.IGNORECASE)),
+    ('if', re.compile(r"^if\s*\(", re.IGNORECASE), re.compile(r"^end\s*if\b", re.IGNORECASE)),
+    ('while', re.compile(r"^while\s*\(", re.IGNORECASE), re.compile(r"^end\s*while\b", re.IGNORECASE)),
+    ('repeat', re.compile(r"^repeat\s*(:.*)?$", re.IGNORECASE), re.compile(r"^repeat\s*while\b", re.IGNORECASE)),
+    ('fork', re.compile(r"^fork\s*$", re.IGNORECASE), re.compile(r"^end\s*(fork|merge)\b", re.IGNORECASE)),
+    ('split', re.compile(r"^split\s*$", re.IGNORECASE), re.compile(r"^end\s*split\b", re.IGNORECASE)),
+    ('switch', re.compile(r"^switch\s*\(", re.IGNORECASE), re.compile(r"^end\s*switch\b", re.IGNORECASE)),
+    ('box', re.compile(r"^box\b", re.IGNORECASE), re.compile(r"^end\s*box\b", re.IGNORECASE)),
+]
+
+# Multi-line texts whose content is free text and must not be checked
+free_text_rules = [
+    ('note', re.compile(r'^[rh]?note\b[^:"]*$', re.IGNORECASE), re.compile(r"^end\s*[rh]?note\b", re.IGNORECASE)),
+    ('legend', re.compile(r"^legend\b[^:]*$", re.IGNORECASE), re.compile(r"^end\s*legend\b", re.IGNORECASE)),
+    ('title', re.compile(r"^title\s*$", re.IGNORECASE), re.compile(r"^end\s*title\b", re.IGNORECASE)),
+    ('ref', re.compile(r"^ref\s+over\b[^:]*$", re.IGNORECASE), re.compile(r"^end\s*ref\b", re.IGNORECASE)),
+]
+
+# An arrow with nothing on its right-hand side, e.g. "Alice ->"
+dangling_arrow_pattern = re.compile(r"(-+|\.+|=+)(\[[^\]]*\])?(-+|\.+)?>>?\s*$|<<?(-+|\.+)\s*$")
+quoted_text_pattern = re.compile(r'"[^"]*"')
+
+
+def expected_start_tag(diagram_type):
+    """
+    Returns the start tag used by the catalog example of a diagram type, or None when any tag will do.
+    """
+    record = resolve_diagram_type(diagram_type)
+    return record.start_tag if record is not None else None
+
+
+def known_start_tags():
+    tags = set(plantuml_start_tags)
+    tags.update(record.start_tag for record in catalog.values() if record.start_tag)
+    return tags
+
+
+def strip_comments(lines, keep_indent=False):
+    """
+    Blanks out ' comments and /' ... '/ block comments, and strips every line, keeping the line numbers.
+    With keep_indent, only trailing whitespace is stripped.
+    """
+    stripped = []
+    in_block_comment = False
+    for line in lines:
+        text = line
+        if in_block_comment:
+            if "'/" in text:
+                text = text.split("'/", 1)[1]
+                in_block_comment = False
+            else:
+                text = ""
+        if "/'" in text:
+            before, after = text.split("/'", 1)
+            if "'/" in after:
+                text = before + after.split("'/", 1)[1]
+            else:
+                text = before
+                in_block_comment = True
+        if text.lstrip().startswith("'"):
+            text = ""
+        stripped.append(text.rstrip() if keep_indent else text.strip())
+    return stripped
+
+
+def strip_diagram_comments(lines, keep_indent=False):
+    """
+    Same as strip_comments, except for data diagrams (@startjson, @startyaml) which have no comments.
+    """
+    start = next((match.group(1).lower() for line in lines if (match := start_tag_pattern.match(line))), None)
+    if start in uncommented_tags:
+        return [line.rstrip() if keep_indent else line.strip() for line in lines]
+    return strip_comments(lines, keep_indent)
+
+
+def validate_plantuml(plantuml_code, diagram_type=None):
+    """
+    Checks a @startXXX ... @endXXX block for errors that would make PlantUML fail, without starting Java.
+
+    Args:
+    - plantuml_code (str): The extracted PlantUML code.
+    - diagram_type (str): The diagram type selected by the user, if any.
+
+    Returns:
+    - list: Diagnostic tuples (line, severity, message); severity is 'error' or 'warning'.
+    """
+    diagnostics = []
+    lines = strip_diagram_comments(plantuml_code.splitlines())
+
+    start_lines = [(number, match.group(1).lower()) for number, line in enumerate(lines, 1)
+                   if (match := start_tag_pattern.match(line))]
+    end_lines = [(number, match.group(1).lower()) for number, line in enumerate(lines, 1)
+                 if (match := end_tag_pattern.match(line))]
+    if not start_lines:
+        return [Diagnostic(1, 'error', "Missing @start tag.")]
+    if not end_lines:
+        return [Diagnostic(len(lines), 'error', f"Missing @end{start_lines[0][1]} tag.")]
+
+    start_line, start_tag = start_lines[0]
+    end_line, end_tag = end_lines[-1]
+    if len(start_lines) > 1:
+        diagnostics.append(Diagnostic(start_lines[1][0], 'error', "Only one @start tag is allowed per diagram."))
+    if end_tag != start_tag:
+        diagnostics.append(Diagnostic(end_line, 'error', f"@end{end_tag} does not match @start{start_tag}."))
+    if start_tag not in known_start_tags():
+        diagnostics.append(Diagnostic(start_line, 'error', f"Unknown diagram tag @start{start_tag}."))
+    expected_tag = expected_start_tag(diagram_type) if diagram_type else None
+    if expected_tag and expected_tag != start_tag:
+        diagnostics.append(Diagnostic(start_line, 'warning', f"A {diagram_type} usually starts with @start{expected_tag}."))
+
+    body = [(number, line) for number, line in enumerate(lines, 1) if start_line < number < end_line]
+    if not any(line for _, line in body):
+        diagnostics.append(Diagnostic(start_line, 'error', "The diagram is empty."))
+        return diagnostics
+
+    # Only @startuml diagrams share the block and arrow syntax checked below
+    if start_tag != 'uml':
+        return diagnostics
+
+    blocks = []
+    free_text = None
+    brace_depth = 0
+    for number, line in body:
+        if not line:
+            continue
+        if free_text:
+            if free_text[3].match(line):
+                free_text = None
+            continue
+        opening = next((rule for rule in free_text_rules if rule[1].match(line)), None)
+        if opening:
+            free_text = (number,) + opening
+            continue
+
+        closing = next((rule for rule in block_rules if rule[2].match(line)), None)
+        if closing and bare_end_pattern.match(line) and not (blocks and blocks[-1][1] == 'group'):
+            # Outside of a sequence group, "end" is the end node of an activity diagram
+            closing = None
+        if closing:
+            if blocks and blocks[-1][1] == closing[0]:
+                blocks.pop()
+            else:
+                diagnostics.append(Diagnostic(number, 'error', f"'{line}' has no matching {closing[0]}."))
+            continue
+        # Arrows and braces only matter outside of labels, activities and quoted text
+        code = quoted_text_pattern.sub('""', line)
+        opening = next((rule for rule in block_rules if rule[1].match(line)), None)
+        if opening and not code.endswith('{'):
+            blocks.append((number, opening[0]))
+
+        if not code.startswith(':'):
+            code = code.split(':', 1)[0].rstrip()
+            if dangling_arrow_pattern.search(code):
+                diagnostics.append(Diagnostic(number, 'error', "Arrow has no target."))
+            if code.startswith('}'):
+                brace_depth -= 1
+                if brace_depth < 0:
+                    diagnostics.append(Diagnostic(number, 'error', "Closing brace without an opening brace."))
+                    brace_depth = 0
+            if code.endswith('{'):
+                brace_depth += 1
+
+    if free_text:
+        diagnostics.append(Diagnostic(free_text[0], 'error', f"{free_text[1]} is never closed with 'end {free_text[1]}'."))
+    for number, name in blocks:
+        diagnostics.append(Diagnostic(number, 'error', f"{name} block is never closed."))
+    if brace_depth > 0:
+        diagnostics.append(Diagnostic(end_line, 'error', f"{brace_depth} opening brace(s) are never closed."))
+    return diagnostics
+
+
+def format_diagnostics(diagnostics):
+    """
+    Formats diagnostics the way PlantUML reports errors, one per line.
+    """
+    return "\n".join(f"Error line {line}: {message}" if severity == 'error' else f"Warning line {line}: {message}"
+                     for line, severity, message in diagnostics)
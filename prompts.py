@@ -0,0 +1,79 @@
+import functools
+import hashlib
+
+from data import any_diagram_type, resolve_diagram_type
+
+# System message of the planning step
+plan_message = "Generate a brief plan based on the user's description. This plan will be used to create a diagram. Keep the plan concise and relevant."
+
+
+class InstructionPrompt:
+    """
+    Compiled system message of one diagram type and combination of sidebar options.
+
+    The text is the option rules (`prefix`, shared by every diagram type with the same options)
+    followed by the diagram type and its example (`type_section`). Both parts are fixed for a
+    given type and options, so the same request always sends the same bytes, which lets the
+    provider-side prompt caches hit. prompt_hash identifies the text for caches and metrics.
+    """
+
+    __slots__ = ('diagram_type', 'prefix', 'type_section', 'text', 'prompt_hash')
+
+    def __init__(self, diagram_type, prefix, type_section):
+        self.diagram_type = diagram_type
+        self.prefix = prefix
+        self.type_section = type_section
+        self.text = prefix + type_section
+        self.prompt_hash = prompt_hash(self.text)
+
+
+def prompt_hash(text):
+    """
+    Returns a short stable hash of a prompt, the same in every process and on every run.
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_prefix(include_title, use_aws_orange_theme, use_note, use_illustration):
+    prefix = "You are a professional PlantUML coder."
+    if include_title:
+        prefix += " Include a title."
+    if use_aws_orange_theme:
+        prefix += " Use aws-orange theme. Syntax: !theme aws-orange"
+    if use_note:
+        prefix += " Use note if needed to explain more details."
+    if use_illustration:
+        prefix += " Use group or card if needed."
+    return prefix
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_instruction_prompt(diagram_type, include_title, use_aws_orange_theme, use_note, use_illustration):
+    example = resolve_diagram_type(diagram_type).example
+    type_name = 'most appropriate diagram' if diagram_type == any_diagram_type else diagram_type
+    type_section = f''' You MUST Output PlantUML code for a {type_name} only and explain nothing.
+    For example the code will start with: {example}.
+    '''
+    return InstructionPrompt(diagram_type, _compile_prefix(include_title, use_aws_orange_theme, use_note, use_illustration), type_section)
+
+
+def compile_instruction_prompt(diagram_type, include_title, use_aws_orange_theme, use_note, use_illustration):
+    """
+    Returns the compiled system message of a diagram type and sidebar options, memoized per combination.
+
+    Args:
+    - diagram_type (str): The diagram type, or one of its aliases.
+    - include_title, use_aws_orange_theme, use_note, use_illustration (bool): The sidebar options.
+
+    Returns:
+    - InstructionPrompt: The shared compiled prompt; treat it as read-only.
+    """
+    return _compile_instruction_prompt(
+        diagram_type, bool(include_title), bool(use_aws_orange_theme), bool(use_note), bool(use_illustration)
+    )
+
+
+# Function to construct the instruction message based on toggles
+def build_instruction_message(diagram_type, include_title, use_aws_orange_theme, use_note, use_illustration):
+    return compile_instruction_prompt(diagram_type, include_title, use_aws_orange_theme, use_note, use_illustration).text
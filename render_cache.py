@@ -0,0 +1,134 @@
+import hashlib
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+
+def normalize_plantuml(plantuml_code):
+    """
+    Normalizes PlantUML source so that formatting-only differences share a cache entry.
+
+    Args:
+    - plantuml_code (str): The PlantUML source.
+
+    Returns:
+    - str: The source with unified line endings, no trailing spaces and no surrounding blank lines.
+    """
+    lines = plantuml_code.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip("\n")
+
+
+class RenderCache:
+    """
+    On-disk, content-addressed cache of rendered diagrams with size-bounded LRU eviction.
+
+    Entries are keyed by a hash of the normalized source, the renderer version and the
+    output format. Sources that PlantUML rejected are stored too, as their error message.
+    The modification time of an entry is its last use, so eviction removes the least
+    recently used files first once the cache grows past max_bytes.
+
+    The size of the cache is kept as a running total, so the directory is only walked on the
+    first write and when the total goes over max_bytes. Eviction then goes down to
+    evict_ratio of max_bytes, so the next walk is not due on the next write.
+    """
+
+    # Share of max_bytes left after an eviction
+    evict_ratio = 0.9
+
+    def __init__(self, cache_dir, max_bytes=256 * 1024 * 1024):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # Bytes in the cache directory, unknown until the first write walks it
+        self._total_bytes = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(plantuml_code, renderer_version, output_format='png'):
+        digest = hashlib.sha256()
+        for part in (renderer_version, output_format, normalize_plantuml(plantuml_code)):
+            digest.update(str(part).encode('utf-8'))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _path(self, key, output_format):
+        return self.cache_dir / key[:2] / f"{key}.{output_format}"
+
+    def get(self, key, output_format='png'):
+        path = self._path(key, output_format)
+        try:
+            data = path.read_bytes()
+        except OSError:
+            self.misses += 1
+            return None
+        try:
+            # Mark the entry as recently used
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return data
+
+    def put(self, key, data, output_format='png'):
+        path = self._path(key, output_format)
+        try:
+            replaced_bytes = path.stat().st_size
+        except OSError:
+            replaced_bytes = 0
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Write to a temporary file first so readers never see a partial image
+            fd, temp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(temp_path, path)
+        except OSError:
+            # A read-only or full disk only costs us the cache, never the render
+            return False
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += len(data) - replaced_bytes
+            if self._total_bytes is None or self._total_bytes > self.max_bytes:
+                self._evict()
+        return True
+
+    def get_error(self, key):
+        """
+        Returns the error of a source that is known to fail, so it is never rendered twice.
+        """
+        data = self.get(key, output_format='error')
+        return data.decode('utf-8') if data is not None else None
+
+    def put_error(self, key, error_message):
+        return self.put(key, error_message.encode('utf-8'), output_format='error')
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+        return entries
+
+    def _evict(self):
+        # Called with the lock held. Walks the directory, which other processes may share, so
+        # the running total is corrected on every eviction
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            for _, size, path in sorted(entries):
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                if total <= self.max_bytes * self.evict_ratio:
+                    break
+        self._total_bytes = total
@@ -0,0 +1,167 @@
+import math
+import os
+import threading
+import time
+
+from plantuml_renderer import PlantUMLRenderer, classify_render_error, renderer_version, retry_delay
+from plantuml_validator import format_diagnostics, validate_plantuml
+from render_scheduler import get_scheduler
+from telemetry import span
+
+
+def render_diagram(plantuml_code, plantuml_jar_path, render_cache=None, output_format='png', retries=2, timeout=None, diagram_type=None):
+    """
+    Renders PlantUML code through the cache, the validator and the shared render pool.
+
+    Args:
+    - plantuml_code (str): The PlantUML source to render.
+    - plantuml_jar_path (str): The path of plantuml.jar.
+    - render_cache (RenderCache): Optional cache of rendered diagrams and of rejected sources.
+    - output_format (str): The PlantUML output format, e.g. 'png'.
+    - retries (int): Number of extra renders after a transient failure.
+    - timeout (float): Seconds allowed for each render, queueing included. Defaults to the pool timeout.
+    - diagram_type (str): The diagram type selected by the user, checked by the validator.
+
+    Returns:
+    - tuple: (image bytes, None) on success or (None, error message) on failure.
+    """
+    with span('render', format=output_format) as render_span:
+        image_bytes, error_message = _render_diagram(plantuml_code, plantuml_jar_path, render_cache, output_format, retries, timeout, diagram_type, render_span)
+        render_span.set(ok=image_bytes is not None, bytes=len(image_bytes or b""))
+        return image_bytes, error_message
+
+
+def _render_diagram(plantuml_code, plantuml_jar_path, render_cache, output_format, retries, timeout, diagram_type, render_span):
+    error_message = None
+
+    # Reruns of an unchanged diagram are served from the render cache without touching Java
+    cache_key = None
+    image_bytes = None
+    if render_cache is not None:
+        cache_key = render_cache.key(plantuml_code, renderer_version(plantuml_jar_path), output_format)
+        image_bytes = render_cache.get(cache_key, output_format)
+    render_span.set(cache_hit=image_bytes is not None)
+
+    # Obviously broken code is reported without spending a render on it
+    if image_bytes is None:
+        diagnostics = validate_plantuml(plantuml_code, diagram_type)
+        syntax_errors = [diagnostic for diagnostic in diagnostics if diagnostic.severity == 'error']
+        warnings = [diagnostic for diagnostic in diagnostics if diagnostic.severity == 'warning']
+        if warnings:
+            # Such as a start tag unusual for the selected type: worth a look, not worth refusing the render
+            render_span.set(validation_warnings=format_diagnostics(warnings))
+        if syntax_errors:
+            render_span.set(error_kind='validation')
+            return None, format_diagnostics(syntax_errors)
+
+        # PlantUML is deterministic, so a source that failed once fails again
+        if render_cache is not None:
+            cached_error = render_cache.get_error(cache_key)
+            if cached_error:
+                render_span.set(error_kind='syntax', negative_cache_hit=True)
+                return None, cached_error
+
+    # Render on the shared worker pool of warm PlantUML processes: the source goes in over stdin
+    # and the image comes back over stdout, with at most one JVM per core for the whole process
+    scheduler = get_scheduler(plantuml_jar_path)
+
+    attempt = 0
+    while image_bytes is None:
+        image_bytes, error_message = scheduler.render(plantuml_code, output_format, timeout=timeout)
+        if image_bytes:
+            if render_cache is not None:
+                render_cache.put(cache_key, image_bytes, output_format)
+            break
+        # Only a busy pool, a timeout in the queue or a crashed JVM are worth another render: a
+        # render that timed out on a JVM would only hold another worker for as long
+        error_kind = classify_render_error(error_message)
+        render_span.set(error_kind=error_kind)
+        if error_kind == 'syntax' and render_cache is not None:
+            render_cache.put_error(cache_key, error_message)
+        if error_kind != 'transient' or attempt >= retries:
+            break
+        time.sleep(retry_delay(error_message, attempt))
+        attempt += 1
+        render_span.set(retries=attempt)
+
+    if image_bytes:
+        return image_bytes, None
+
+    return None, error_message
+
+
+def render_diagrams(sources, plantuml_jar_path, render_cache=None, output_format='png', shards=None, timeout=60, per_jvm=20):
+    """
+    Renders many PlantUML sources with one or a few dedicated JVMs.
+
+    The sources are dealt round-robin to `shards` warm PlantUML processes, each rendering its
+    share one after the other over its pipe, so the JVM start-up is paid once per shard rather
+    than once per file. Cached sources and sources the validator rejects never reach a JVM.
+
+    Args:
+    - sources (list): The PlantUML sources to render.
+    - plantuml_jar_path (str): The path of plantuml.jar.
+    - render_cache (RenderCache): Optional cache of rendered diagrams and of rejected sources.
+    - output_format (str): The PlantUML output format, e.g. 'png'.
+    - shards (int): Number of JVMs. Defaults to one per `per_jvm` sources, at most one per core.
+    - timeout (float): Seconds allowed for each render.
+    - per_jvm (int): Sources worth the start-up of one more JVM, when shards is not given.
+
+    Returns:
+    - list: One (image bytes, error message) tuple per source, in the order of `sources`.
+    """
+    results = [None] * len(sources)
+    cache_keys = [None] * len(sources)
+    pending = []
+    version = renderer_version(plantuml_jar_path) if render_cache is not None else None
+    for index, plantuml_code in enumerate(sources):
+        if render_cache is not None:
+            cache_keys[index] = render_cache.key(plantuml_code, version, output_format)
+            image_bytes = render_cache.get(cache_keys[index], output_format)
+            if image_bytes is not None:
+                results[index] = (image_bytes, None)
+                continue
+            cached_error = render_cache.get_error(cache_keys[index])
+            if cached_error:
+                results[index] = (None, cached_error)
+                continue
+        syntax_errors = [diagnostic for diagnostic in validate_plantuml(plantuml_code) if diagnostic.severity == 'error']
+        if syntax_errors:
+            results[index] = (None, format_diagnostics(syntax_errors))
+            continue
+        pending.append(index)
+
+    if not pending:
+        return results
+
+    shards = shards or min(os.cpu_count() or 1, math.ceil(len(pending) / per_jvm))
+    shards = max(1, min(shards, len(pending)))
+
+    def render_shard(indexes):
+        renderer = PlantUMLRenderer(plantuml_jar_path, output_format=output_format, timeout=timeout, max_renders=len(indexes) + 1)
+        try:
+            for index in indexes:
+                try:
+                    results[index] = renderer.render(sources[index])
+                except Exception as e:
+                    results[index] = (None, f"An error occurred: {str(e)}")
+        finally:
+            renderer.close()
+
+    threads = [
+        threading.Thread(target=render_shard, args=(pending[shard::shards],), daemon=True)
+        for shard in range(shards)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if render_cache is not None:
+        for index in pending:
+            image_bytes, error_message = results[index]
+            if image_bytes:
+                render_cache.put(cache_keys[index], image_bytes, output_format)
+            elif classify_render_error(error_message) == 'syntax':
+                render_cache.put_error(cache_keys[index], error_message)
+    return results
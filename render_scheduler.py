@@ -0,0 +1,236 @@
+import atexit
+import collections
+import concurrent.futures
+import math
+import os
+import threading
+import time
+
+from plantuml_renderer import PlantUMLRenderer
+
+# A JVM idle for longer than this is health-checked before it gets the next job
+health_check_interval = 60
+# Seconds a job waits for a worker warm for its format before a worker of another format takes it
+format_switch_wait = 2
+
+
+class RenderScheduler:
+    """
+    Runs PlantUML renders on a fixed pool of workers, each owning one warm PlantUML JVM.
+
+    Jobs wait in a bounded queue. When the queue is full, new jobs are turned away at once
+    with a "busy, retry in N s" message instead of starting more JVMs, so a traffic spike
+    costs latency rather than memory.
+
+    The output format is fixed when a JVM starts, so jobs go to a worker already warm for their
+    format: an idle worker only takes a job of another format, and restarts its JVM, when no JVM
+    has that format yet or the job has waited format_switch_wait seconds for one.
+    """
+
+    def __init__(self, plantuml_jar_path, workers=None, max_queue=None, job_timeout=60):
+        self.plantuml_jar_path = str(plantuml_jar_path)
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue = max_queue if max_queue is not None else self.workers * 4
+        self.job_timeout = job_timeout
+        # Waiting jobs per output format, oldest first, and their total count
+        self._jobs = collections.defaultdict(collections.deque)
+        self._queued = 0
+        # Workers per output format of their JVM, busy or idle
+        self._warm = collections.Counter()
+        # JVMs started by renderers that were since replaced
+        self._retired_jvms = 0
+        self._closing = False
+        self._condition = threading.Condition()
+        self._durations = collections.deque(maxlen=50)
+        self._renderers = []
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start_workers(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                # Each worker starts its JVM lazily, on its first job
+                self._renderers.append(None)
+                thread = threading.Thread(target=self._work, args=(len(self._renderers) - 1,), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _next_job(self, worker_format):
+        # Called with the condition held. Returns the oldest job of the worker's format, else the
+        # oldest job of another format it may take (any job for a worker without a JVM yet), and
+        # otherwise the seconds until one of the waiting jobs may be taken
+        if self._jobs[worker_format]:
+            return self._jobs[worker_format].popleft(), None
+        now = time.monotonic()
+        oldest = None
+        wait = None
+        for job_format, jobs in self._jobs.items():
+            if not jobs:
+                continue
+            switch_in = jobs[0][4] + format_switch_wait - now
+            if worker_format is not None and self._warm[job_format] and switch_in > 0 and not self._closing:
+                wait = switch_in if wait is None else min(wait, switch_in)
+            elif oldest is None or jobs[0][4] < oldest[4]:
+                oldest = jobs[0]
+        if oldest is None:
+            return None, wait
+        self._jobs[oldest[1]].popleft()
+        if worker_format is not None:
+            self._warm[worker_format] -= 1
+        self._warm[oldest[1]] += 1
+        return oldest, None
+
+    def _work(self, index):
+        renderer = None
+        last_used_at = 0.0
+        while True:
+            worker_format = renderer.output_format if renderer is not None else None
+            with self._condition:
+                while True:
+                    job, wait = self._next_job(worker_format)
+                    if job is not None or self._closing:
+                        break
+                    self._condition.wait(wait)
+                if job is not None:
+                    self._queued -= 1
+            if job is None:
+                return
+            plantuml_code, output_format, timeout, future, enqueued_at = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            if time.monotonic() - enqueued_at > timeout:
+                # The caller has already given up on this job
+                future.set_result((None, f"Render timed out after {timeout} s in the queue"))
+                continue
+
+            # A job of another format replaces the JVM of this worker: the pool never runs more
+            # than one JVM per worker
+            if renderer is not None and renderer.output_format != output_format:
+                renderer.close()
+                with self._condition:
+                    self._retired_jvms += 1 + renderer.restarts
+                renderer = None
+            if renderer is None:
+                renderer = PlantUMLRenderer(self.plantuml_jar_path, output_format=output_format, timeout=self.job_timeout)
+                self._renderers[index] = renderer
+            elif time.monotonic() - last_used_at > health_check_interval and not renderer.health_check():
+                # The JVM stopped answering while idle: replace it before it fails a real render
+                renderer.close()
+                renderer.restarts += 1
+
+            started_at = time.monotonic()
+            try:
+                result = renderer.render(plantuml_code, timeout=timeout)
+            except Exception as e:
+                result = (None, f"An error occurred: {str(e)}")
+            last_used_at = time.monotonic()
+            self._durations.append(last_used_at - started_at)
+            future.set_result(result)
+
+    def retry_after(self):
+        """
+        Estimates in seconds how long a turned-away caller should wait before trying again.
+        """
+        durations = list(self._durations)
+        average = sum(durations) / len(durations) if durations else 1.0
+        return max(1, math.ceil(average * (self._queued + 1) / self.workers))
+
+    def submit(self, plantuml_code, output_format='png', timeout=None):
+        """
+        Queues a render and returns a future resolving to (image bytes, error message).
+
+        The render itself is stopped after `timeout` seconds, by default job_timeout.
+        Returns None when the queue is full.
+        """
+        self._start_workers()
+        future = concurrent.futures.Future()
+        with self._condition:
+            if self._queued >= self.max_queue:
+                return None
+            self._jobs[output_format].append((plantuml_code, output_format, timeout or self.job_timeout, future, time.monotonic()))
+            self._queued += 1
+            self._condition.notify_all()
+        return future
+
+    def render(self, plantuml_code, output_format='png', timeout=None):
+        """
+        Renders a diagram on the pool and waits for the result.
+
+        Args:
+        - plantuml_code (str): The PlantUML source to render.
+        - output_format (str): The PlantUML output format, e.g. 'png'.
+        - timeout (float): Seconds allowed to the render, and to the wait in the queue. Defaults to job_timeout.
+
+        Returns:
+        - tuple: (image bytes, None) on success or (None, error message) on failure.
+        """
+        timeout = timeout or self.job_timeout
+        future = self.submit(plantuml_code, output_format, timeout)
+        if future is None:
+            return None, f"Renderer busy, retry in {self.retry_after()} s"
+        try:
+            return future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            if future.cancel():
+                return None, f"Render timed out after {timeout} s in the queue"
+        # The job is rendering and stops at its own timeout: wait for it, so that a retry
+        # never renders the same source next to a copy that is still running
+        return future.result()
+
+    def live_renderers(self):
+        """
+        Returns the renderers of the pool whose JVM is currently running.
+        """
+        with self._lock:
+            return [renderer for renderer in self._renderers if renderer is not None and renderer.is_alive()]
+
+    def jvms_started(self):
+        """
+        Returns the number of JVMs the pool has started, counting restarts and replaced renderers.
+        """
+        with self._condition:
+            renderers = [renderer for renderer in self._renderers if renderer is not None]
+            return self._retired_jvms + sum(1 + renderer.restarts for renderer in renderers)
+
+    def close(self):
+        with self._lock:
+            with self._condition:
+                self._closing = True
+                self._condition.notify_all()
+            for thread in self._threads:
+                thread.join(timeout=5)
+            for renderer in self._renderers:
+                if renderer is not None:
+                    renderer.close()
+            self._threads = []
+            with self._condition:
+                self._retired_jvms += sum(1 + renderer.restarts for renderer in self._renderers if renderer is not None)
+                self._renderers = []
+                self._warm.clear()
+                self._closing = False
+
+
+# Schedulers shared by every Streamlit session of this process
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(plantuml_jar_path):
+    """
+    Returns the process-wide render scheduler for a jar, creating it on first use.
+    """
+    key = str(plantuml_jar_path)
+    with _schedulers_lock:
+        scheduler = _schedulers.get(key)
+        if scheduler is None:
+            scheduler = RenderScheduler(plantuml_jar_path)
+            _schedulers[key] = scheduler
+        return scheduler
+
+
+@atexit.register
+def _close_schedulers():
+    with _schedulers_lock:
+        for scheduler in _schedulers.values():
+            scheduler.close()
+        _schedulers.clear()
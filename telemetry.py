@@ -0,0 +1,272 @@
+import asyncio
+import atexit
+import collections
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+
+# JSON log receiving one line per finished span, e.g. ./spans.jsonl; off unless set, as it grows without bound
+span_log_path = os.environ.get('SPAN_LOG_PATH', '')
+
+# Upper bounds in seconds of the Prometheus duration histogram buckets
+duration_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Attributes counted in Prometheus when they are true, per stage
+counted_attributes = ('cache_hit', 'budget_exceeded', 'usage_estimated')
+
+# Token counts reported by the LLM providers, summed in Prometheus per stage, and the estimates
+# made from the text length when a stream ended before its usage was reported
+token_attributes = (
+    'input_tokens', 'cached_input_tokens', 'cache_write_tokens', 'output_tokens',
+    'estimated_input_tokens', 'estimated_output_tokens',
+)
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    """
+    One timed stage of a request, such as the plan, the LLM generation or the render.
+
+    Spans started inside another span share its trace_id, so the stages of one click can be
+    listed together. Attributes can be set while the span runs.
+    """
+
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'attributes', 'started_at', 'duration', 'status', 'error')
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex[:16]
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes or {})
+        self.started_at = time.time()
+        self.duration = None
+        self.status = 'ok'
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, **counts):
+        # Counts of several calls in one span, such as concurrent candidates, add up
+        for name, count in counts.items():
+            self.attributes[name] = self.attributes.get(name, 0) + count
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start': round(self.started_at, 6),
+            'duration_ms': round(self.duration * 1000, 3) if self.duration is not None else None,
+            'status': self.status,
+            'error': self.error,
+            'attributes': self.attributes,
+        }
+
+
+class Telemetry:
+    """
+    Process-wide sink of finished spans: Prometheus aggregates, the JSON log and the recent spans.
+
+    Prometheus gets one duration histogram and one error counter per stage, with the stage as
+    the only label to keep the series count bounded. Every other attribute goes to the JSON log.
+    """
+
+    def __init__(self, log_path=None, recent=500):
+        self.log_path = log_path
+        self.recent = collections.deque(maxlen=recent)
+        self._histograms = {}
+        self._errors = collections.Counter()
+        self._counted = collections.Counter()
+        self._tokens = collections.Counter()
+        self._log_file = None
+        self._lock = threading.Lock()
+
+    def record(self, span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock:
+            self.recent.append(span)
+            histogram = self._histograms.setdefault(span.name, [[0] * len(duration_buckets), 0.0, 0])
+            for index, bound in enumerate(duration_buckets):
+                if span.duration <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += span.duration
+            histogram[2] += 1
+            if span.status == 'error':
+                self._errors[span.name] += 1
+            for attribute in counted_attributes:
+                if span.attributes.get(attribute):
+                    self._counted[(span.name, attribute)] += 1
+            for attribute in token_attributes:
+                if span.attributes.get(attribute):
+                    self._tokens[(span.name, attribute)] += span.attributes[attribute]
+            if self.log_path:
+                try:
+                    if self._log_file is None:
+                        self._log_file = open(self.log_path, 'a', encoding='utf-8')
+                    self._log_file.write(line + "\n")
+                    self._log_file.flush()
+                except OSError:
+                    # Metrics must never break a request
+                    self.log_path = None
+
+    def trace(self, trace_id):
+        """
+        Returns the recent spans of one trace, in start order.
+        """
+        with self._lock:
+            return sorted((span for span in self.recent if span.trace_id == trace_id), key=lambda span: span.started_at)
+
+    def prometheus_text(self):
+        """
+        Returns the aggregates in the Prometheus text exposition format.
+        """
+        lines = [
+            "# HELP diagram_stage_duration_seconds Duration of each pipeline stage.",
+            "# TYPE diagram_stage_duration_seconds histogram",
+        ]
+        with self._lock:
+            for stage, (buckets, total, count) in sorted(self._histograms.items()):
+                for bound, bucket_count in zip(duration_buckets, buckets):
+                    lines.append(f'diagram_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {bucket_count}')
+                lines.append(f'diagram_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+                lines.append(f'diagram_stage_duration_seconds_sum{{stage="{stage}"}} {total:.6f}')
+                lines.append(f'diagram_stage_duration_seconds_count{{stage="{stage}"}} {count}')
+            lines.append("# HELP diagram_stage_errors_total Stages that raised an error.")
+            lines.append("# TYPE diagram_stage_errors_total counter")
+            for stage, count in sorted(self._errors.items()):
+                lines.append(f'diagram_stage_errors_total{{stage="{stage}"}} {count}')
+            lines.append("# HELP diagram_stage_attribute_total Stages with a true counted attribute, such as a cache hit.")
+            lines.append("# TYPE diagram_stage_attribute_total counter")
+            for (stage, attribute), count in sorted(self._counted.items()):
+                lines.append(f'diagram_stage_attribute_total{{stage="{stage}",attribute="{attribute}"}} {count}')
+            lines.append("# HELP diagram_llm_tokens_total Tokens reported by the LLM providers; cached input tokens are part of the input tokens, estimated ones are not.")
+            lines.append("# TYPE diagram_llm_tokens_total counter")
+            for (stage, attribute), count in sorted(self._tokens.items()):
+                lines.append(f'diagram_llm_tokens_total{{stage="{stage}",kind="{attribute[:-len("_tokens")]}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        with self._lock:
+            if self._log_file is not None:
+                self._log_file.close()
+                self._log_file = None
+
+
+_telemetry = None
+_telemetry_lock = threading.Lock()
+
+
+def get_telemetry():
+    """
+    Returns the process-wide telemetry sink, creating it on first use.
+    """
+    global _telemetry
+    with _telemetry_lock:
+        if _telemetry is None:
+            _telemetry = Telemetry(log_path=span_log_path or None)
+        return _telemetry
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """
+    Times a block as a span of the current trace, or of a new trace outside of any span.
+
+    Args:
+    - name (str): The stage name, e.g. 'render'.
+    - attributes: Initial attributes, e.g. diagram_type or retry.
+
+    Returns:
+    - Span: The running span, to add attributes with span.set(...).
+    """
+    current = Span(name, parent=_current_span.get(), attributes=attributes)
+    token = _current_span.set(current)
+    started_at = time.perf_counter()
+    try:
+        yield current
+    except asyncio.CancelledError:
+        # A losing candidate or an abandoned request, not a failure
+        current.status = 'cancelled'
+        raise
+    except BaseException as e:
+        current.status = 'error'
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.duration = time.perf_counter() - started_at
+        _current_span.reset(token)
+        get_telemetry().record(current)
+
+
+def traced(name, **attributes):
+    """
+    Decorator running every call of a function in its own span.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name, **attributes):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class _NoSpan:
+    # Stand-in for current_span() outside of any span, so that callers need no check
+    def set(self, **attributes):
+        pass
+
+    def add(self, **counts):
+        pass
+
+
+def current_span():
+    """
+    Returns the innermost running span, or a stand-in ignoring attributes outside of any span.
+    """
+    return _current_span.get() or _NoSpan()
+
+
+_metrics_server = None
+
+
+def start_metrics_server(port):
+    """
+    Serves the Prometheus text format on http://0.0.0.0:<port>/metrics, once per process.
+    """
+    # Imported here: most processes never serve metrics, and http.server is slow to import
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            body = get_telemetry().prometheus_text().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    global _metrics_server
+    with _telemetry_lock:
+        if _metrics_server is None:
+            _metrics_server = ThreadingHTTPServer(('0.0.0.0', int(port)), MetricsHandler)
+            threading.Thread(target=_metrics_server.serve_forever, name='metrics-server', daemon=True).start()
+        return _metrics_server
+
+
+@atexit.register
+def _close_telemetry():
+    if _telemetry is not None:
+        _telemetry.close()
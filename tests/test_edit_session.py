@@ -0,0 +1,18 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from edit_session import edit_key
+
+
+def test_yaml_quoted_key_edit_changes_the_key():
+    assert edit_key("@startyaml\n'name': alice\n@endyaml") != edit_key("@startyaml\n'name': bob\n@endyaml")
+
+
+def test_indentation_changes_the_key():
+    assert edit_key("@startyaml\na:\n  b: 1\n@endyaml") != edit_key("@startyaml\na:\nb: 1\n@endyaml")
+
+
+def test_comments_and_blank_lines_do_not_change_the_key():
+    assert edit_key("@startuml\nA -> B\n@enduml") == edit_key("@startuml\n' note\n\nA -> B   \n@enduml")
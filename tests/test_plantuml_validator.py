@@ -0,0 +1,27 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from plantuml_validator import validate_plantuml
+
+
+def errors(plantuml_code, diagram_type=None):
+    return [diagnostic for diagnostic in validate_plantuml(plantuml_code, diagram_type) if diagnostic.severity == 'error']
+
+
+def test_activity_end_is_not_a_group_end():
+    assert errors("@startuml\nstart\n:step;\nend\n@enduml") == []
+
+
+def test_end_still_closes_a_sequence_group():
+    assert errors("@startuml\nalt ok\nA -> B\nend\n@enduml") == []
+    assert errors("@startuml\nalt ok\nA -> B\n@enduml")
+
+
+def test_yaml_quoted_keys_are_not_comments():
+    assert errors("@startyaml\n'name': alice\n@endyaml") == []
+
+
+def test_title_block_text_is_not_checked():
+    assert errors("@startuml\ntitle\nretry <--\nend title\nA -> B\n@enduml") == []